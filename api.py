@@ -0,0 +1,325 @@
+"""Warbler's JSON API, version 1, mounted at /api/v1.
+
+Clients authenticate with the same session cookie as the site. Lists come
+a page at a time, newest first; pass a page's `next` value back as
+`?before=` (message lists) or `?after=` (user lists) for the next one.
+`?limit=` sets the page size (up to MAX_LIMIT).
+
+Responses are built straight from the selected columns, without loading
+ORM objects, and encoded with orjson when it's installed. They're gzipped
+when the client accepts it, or compressed with brotli when that's both
+installed and accepted.
+"""
+
+import gzip
+import json
+
+from flask import Blueprint, abort, current_app, g, request
+from werkzeug.exceptions import HTTPException
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from pagination import paginate, paginate_by_id
+from posting import post_message, delete_message
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Largest page a client can ask for
+MAX_LIMIT = 100
+
+# Smaller responses aren't worth compressing
+MIN_COMPRESS_SIZE = 500
+
+# Columns of a message, and of its author, in API responses
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                   User.id.label('user_id'), User.username, User.image_url)
+
+# Columns of a user in lists of users
+USER_COLUMNS = (User.id, User.username, User.image_url, User.bio)
+
+# Columns of a user's profile
+PROFILE_COLUMNS = USER_COLUMNS + (
+    User.header_image_url, User.location, User.messages_count,
+    User.following_count, User.followers_count, User.likes_count)
+
+
+def dumps(data):
+    """Encode `data` as JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(',', ':')).encode('UTF-8')
+
+
+def json_response(data, status=200):
+    """Response with `data` as its JSON body."""
+
+    return current_app.response_class(dumps(data), status=status,
+                                      mimetype='application/json')
+
+
+def message_json(row):
+    """JSON-ready dict of a row of MESSAGE_COLUMNS."""
+
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+    }
+
+
+def page_limit():
+    """Page size the request asks for."""
+
+    limit = request.args.get('limit', current_app.config['FEED_PAGE_SIZE'],
+                             type=int)
+
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def message_page(query, timestamp_col=Message.timestamp, id_col=Message.id,
+                 order_col=None):
+    """Response with one page of the messages selected by `query` (a
+    query for MESSAGE_COLUMNS), paged by `?before=`.
+
+    With `order_col`, the page is ordered by it alone, highest first (see
+    pagination.paginate_by_id).
+    """
+
+    before = request.args.get('before')
+
+    try:
+        if order_col is None:
+            rows, next_cursor = paginate(query, timestamp_col, id_col,
+                                         before=before, per_page=page_limit())
+        else:
+            rows, next_cursor = paginate_by_id(query, order_col, before=before,
+                                               per_page=page_limit())
+    except ValueError:
+        abort(400)
+
+    return json_response({'messages': [message_json(row) for row in rows],
+                          'next': next_cursor})
+
+
+def user_page(query):
+    """Response with one page of the users selected by `query` (a query for
+    USER_COLUMNS) in id order, paged by `?after=`."""
+
+    after = request.args.get('after', 0, type=int)
+    limit = page_limit()
+
+    # Fetch one extra row to find out whether there's another page
+    rows = query.filter(User.id > after).order_by(User.id).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+
+    return json_response({'users': [row._asdict() for row in rows[:limit]],
+                          'next': next_cursor})
+
+
+def messages_query():
+    """Query for MESSAGE_COLUMNS of messages joined to their authors."""
+
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .join(User, User.id == Message.user_id))
+
+
+def require_user():
+    """Respond with a 401 unless someone is logged in."""
+
+    if not g.user:
+        abort(401)
+
+
+def get_user_or_404(user_id):
+    """Respond with a 404 unless user `user_id` exists."""
+
+    if not db.session.query(User.query.filter(User.id == user_id)
+                            .exists()).scalar():
+        abort(404)
+
+
+@api.errorhandler(HTTPException)
+def handle_error(error):
+    """Report errors as JSON, not HTML pages."""
+
+    return json_response({'error': error.description}, error.code)
+
+
+@api.after_request
+def compress(resp):
+    """Compress the response body in an encoding the client accepts."""
+
+    accepted = request.accept_encodings
+
+    if (resp.direct_passthrough or 'Content-Encoding' in resp.headers or
+            resp.content_length is None or
+            resp.content_length < MIN_COMPRESS_SIZE):
+        return resp
+
+    if brotli is not None and 'br' in accepted:
+        resp.set_data(brotli.compress(resp.get_data()))
+        resp.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in accepted:
+        resp.set_data(gzip.compress(resp.get_data(), compresslevel=5))
+        resp.headers['Content-Encoding'] = 'gzip'
+
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's home timeline."""
+
+    require_user()
+
+    return message_page(
+        db.session
+        .query(*MESSAGE_COLUMNS)
+        .select_from(TimelineEntry)
+        .join(Message, Message.id == TimelineEntry.message_id)
+        .join(User, User.id == TimelineEntry.author_id)
+        .filter(TimelineEntry.user_id == g.user.id),
+        TimelineEntry.timestamp,
+        TimelineEntry.message_id)
+
+
+@api.route('/users/<int:user_id>')
+def user_profile(user_id):
+    """A user's profile, and whether the logged-in user follows them."""
+
+    row = (db.session
+           .query(*PROFILE_COLUMNS)
+           .filter(User.id == user_id)
+           .first())
+
+    if row is None:
+        abort(404)
+
+    profile = row._asdict()
+
+    if g.user:
+        profile['followed'] = Follows.exists(g.user.id, user_id)
+
+    return json_response(profile)
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages."""
+
+    get_user_or_404(user_id)
+
+    return message_page(messages_query().filter(Message.user_id == user_id))
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """The users a user follows."""
+
+    require_user()
+    get_user_or_404(user_id)
+
+    return user_page(
+        db.session
+        .query(*USER_COLUMNS)
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id))
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """The users following a user."""
+
+    require_user()
+    get_user_or_404(user_id)
+
+    return user_page(
+        db.session
+        .query(*USER_COLUMNS)
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id))
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """The messages a user liked, newest like first."""
+
+    require_user()
+    get_user_or_404(user_id)
+
+    return message_page(
+        messages_query()
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id),
+        order_col=Likes.id)
+
+
+@api.route('/messages', methods=['POST'])
+def create_message():
+    """Post a message: `{"text": "..."}`.
+
+    Only takes JSON bodies, which pages on other sites can't send with the
+    user's cookie without a CORS preflight.
+    """
+
+    require_user()
+
+    if not request.is_json:
+        abort(415)
+
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict):
+        abort(400, "body must be a JSON object.")
+
+    text = body.get('text')
+
+    if not isinstance(text, str) or not 0 < len(text) <= 140:
+        abort(400, "text must be 1 to 140 characters.")
+
+    msg = post_message(g.user.id, text)
+
+    return json_response({
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'user': {
+            'id': g.user.id,
+            'username': g.user.username,
+            'image_url': g.user.image_url,
+        },
+    }, 201)
+
+
+@api.route('/messages/<int:message_id>', methods=['DELETE'])
+def destroy_message(message_id):
+    """Delete one of the logged-in user's messages."""
+
+    require_user()
+
+    msg = Message.query.get_or_404(message_id)
+
+    if msg.user_id != g.user.id:
+        abort(403)
+
+    delete_message(msg)
+
+    return '', 204
@@ -1,11 +1,31 @@
+import hashlib
+import hmac
 import os
+import time
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, jsonify)
 from flask_debugtoolbar import DebugToolbarExtension
+from werkzeug.middleware.proxy_fix import ProxyFix
 from sqlalchemy.exc import IntegrityError
-
+from sqlalchemy.orm import load_only, make_transient_to_detached, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+import hashing
+import metrics
+import parallel
+from api import api
+from cache import TTLCache, TaggedCache
+from explain import explain_command
+from fragments import FragmentCacheExtension
 from forms import UserAddForm, LoginForm, MessageForm, UserForm
-from models import db, connect_db, User, Message
+from jobs import enqueue, jobs_command, status_counts
+from models import db, connect_db, User, Message, Follows, Likes, TimelineEntry
+from pagination import paginate, paginate_by_id, page_query
+from posting import post_message, delete_message
+from ratelimit import RateLimiter, normalize_username, rate_limited
+from search import search_users, search_messages
 
 CURR_USER_KEY = "curr_user"
 
@@ -17,31 +37,294 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Connection pool of each worker process (not used with SQLite): connections
+# kept open, extra ones opened under load, seconds to wait for one before
+# giving up, seconds before one is replaced (-1: never), and whether each is
+# tested before use
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', -1))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '') == '1'
+# Milliseconds a Postgres statement may run before it's cancelled (0: no limit)
+app.config['DB_STATEMENT_TIMEOUT'] = int(
+    os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+# File logging statements slower than SLOW_QUERY_THRESHOLD_MS, with their
+# plans (empty: off), and the fraction of them logged (see slowlog.py)
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG', '')
+app.config['SLOW_QUERY_THRESHOLD_MS'] = int(
+    os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+app.config['SLOW_QUERY_SAMPLE_RATE'] = float(
+    os.environ.get('SLOW_QUERY_SAMPLE_RATE', 1))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# Messages per page on feeds; more are fetched with a `?before=` cursor
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 20))
+# Users per page on the user directory and user search results
+app.config['USERS_PAGE_SIZE'] = int(os.environ.get('USERS_PAGE_SIZE', 24))
+# bcrypt cost for new password hashes; older hashes are upgraded on login
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# Password hashes computed at once per process (the rest wait their turn)
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', hashing.DEFAULT_WORKERS))
+# Seconds a logged-in user's row is cached between requests (0 to disable)
+app.config['SESSION_USER_CACHE_TTL'] = int(
+    os.environ.get('SESSION_USER_CACHE_TTL', 30))
+# Login/signup attempts allowed per RATE_LIMIT_PERIOD seconds (see ratelimit.py)
+app.config['RATE_LIMIT_STORE_URL'] = os.environ.get('RATE_LIMIT_STORE_URL', '')
+app.config['RATE_LIMIT_PERIOD'] = int(
+    os.environ.get('RATE_LIMIT_PERIOD', 300))
+app.config['RATE_LIMIT_PER_IP'] = int(os.environ.get('RATE_LIMIT_PER_IP', 30))
+app.config['RATE_LIMIT_PER_USERNAME'] = int(
+    os.environ.get('RATE_LIMIT_PER_USERNAME', 10))
+# Reverse proxies in front of the app; their X-Forwarded-For/-Proto headers
+# give the client's address and scheme (0: trust no headers, use the address
+# connecting to the app)
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+# Seconds a wrong username/password pair is rejected without rechecking it
+app.config['FAILED_LOGIN_CACHE_TTL'] = int(
+    os.environ.get('FAILED_LOGIN_CACHE_TTL', 300))
+# Seconds a page rendered for anonymous visitors is served from the response
+# cache (0 to disable). Writes invalidate it at once in the worker that
+# handles them; other workers serve it until it expires.
+app.config['RESPONSE_CACHE_TTL'] = int(
+    os.environ.get('RESPONSE_CACHE_TTL', 60))
+# Seconds a rendered message/user card is kept (0 to disable). Cards are
+# versioned, so this only bounds how long unused ones take memory.
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+# Run the home page's independent queries at once, each on its own pooled
+# connection (see parallel.py)
+app.config['FEED_PARALLEL_FETCH'] = (
+    os.environ.get('FEED_PARALLEL_FETCH', '') == '1')
+app.config['FEED_FETCH_WORKERS'] = int(
+    os.environ.get('FEED_FETCH_WORKERS', parallel.DEFAULT_WORKERS))
+# Token GET /internal/metrics must be sent with, as a bearer token (empty:
+# the endpoint is off; see metrics.py)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Report each request's time, SQL statements and rows loaded in a
+# Server-Timing header (see metrics.py)
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '') == '1'
+# Run background jobs at once, in the request, instead of queueing them for
+# `flask jobs work` (see jobs.py); then tries per job, seconds before the
+# first retry (doubling after that), and seconds a worker may hold a job
+app.config['JOBS_SYNC'] = os.environ.get('JOBS_SYNC', '') == '1'
+app.config['JOBS_MAX_ATTEMPTS'] = int(os.environ.get('JOBS_MAX_ATTEMPTS', 5))
+app.config['JOBS_RETRY_DELAY'] = int(os.environ.get('JOBS_RETRY_DELAY', 10))
+app.config['JOBS_LEASE'] = int(os.environ.get('JOBS_LEASE', 300))
 
 # Comment below to turn off flask debug toolbar
 # toolbar = DebugToolbarExtension(app)
 
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app,
+                            x_for=app.config['TRUSTED_PROXIES'],
+                            x_proto=app.config['TRUSTED_PROXIES'])
+
 connect_db(app)
+app.cli.add_command(explain_command)
+app.cli.add_command(jobs_command)
+app.register_blueprint(api)
+# registered first, so turned-away attempts don't even load g.user
+limiter = RateLimiter(app)
+fetcher = parallel.ParallelFetcher(app)
+
+app.register_blueprint(metrics.internal)
+request_metrics = metrics.RequestMetrics(app)
+metrics.register('rate_limit_rejections', lambda: dict(limiter.rejections))
+metrics.register('jobs', status_counts)
+
+
+# full path -> page rendered for anonymous visitors (see @cacheable)
+responses = TaggedCache(maxsize=1000, ttl=app.config['RESPONSE_CACHE_TTL'])
+# so writes outside this module (see posting.py) can invalidate it
+app.extensions['responses'] = responses
+
+# {% cache %} key -> rendered card (see fragments.py)
+fragments = TTLCache(maxsize=20000, ttl=app.config['FRAGMENT_CACHE_TTL'])
+app.jinja_env.add_extension(FragmentCacheExtension)
+app.jinja_env.fragment_cache = fragments
+
+
+def cacheable(max_age):
+    """Let anonymous GETs of a view be served from the response cache, and
+    cached by browsers and CDNs for up to `max_age` seconds:
+
+        @app.route('/messages/<int:message_id>')
+        @cacheable(max_age=60)
+        def messages_show(message_id): ...
+
+    The view should tag what it renders with cache_tags(), so the routes
+    changing it can invalidate the cached page.
+    """
+
+    def decorator(view):
+        view.cache_max_age = max_age
+        return view
+
+    return decorator
+
+
+def cache_tags(*tags):
+    """Tag the page being rendered with the users and messages it shows,
+    as `'user:<id>'` and `'message:<id>'`."""
+
+    g.setdefault('cache_tags', set()).update(tags)
+
+
+def paginate_messages(query, timestamp_col=Message.timestamp,
+                      id_col=Message.id):
+    """Page through `query` using the request's `?before=` cursor.
+
+    Responds with a 400 if the cursor is malformed.
+    """
+
+    try:
+        return paginate(query, timestamp_col, id_col,
+                        before=request.args.get('before'),
+                        per_page=app.config['FEED_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+# Columns of g.user that every page uses (the nav bar and home sidebar).
+# Anything else is loaded on first use, or up front if a view declares it
+# with @loads_user.
+SESSION_USER_COLUMNS = ('id', 'username', 'image_url', 'header_image_url')
+
+# user id -> SESSION_USER_COLUMNS values; invalidated on profile edit/delete
+session_users = TTLCache(maxsize=10000,
+                         ttl=app.config['SESSION_USER_CACHE_TTL'])
+
+
+def loads_user(*attrs):
+    """Declare the extra `g.user` columns and relationships a view uses.
+
+    They are fetched together with g.user (one query per relationship)
+    instead of lazily, one SELECT per attribute:
+
+        @app.route('/users/profile')
+        @loads_user('email', 'bio')
+        def profile(): ...
+    """
+
+    def decorator(view):
+        view.user_attrs = attrs
+        return view
+
+    return decorator
+
+
+def load_session_user(user_id, attrs=()):
+    """Load the logged-in user, with `attrs` loaded eagerly.
+
+    Without extra `attrs` the user's basic columns come from the session
+    user cache, costing no queries on a cache hit. Returns None if there is
+    no such user.
+    """
+
+    if not attrs:
+        values = session_users.get(user_id)
+
+        if values is None:
+            row = (db.session
+                   .query(*(getattr(User, col) for col in SESSION_USER_COLUMNS))
+                   .filter(User.id == user_id)
+                   .first())
+
+            if row is None:
+                return None
+
+            values = dict(zip(SESSION_USER_COLUMNS, row))
+            session_users.set(user_id, values)
+
+        # Attach a copy to this request's session without querying; the
+        # columns we didn't cache load together the first time one is used.
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    relationships = User.__mapper__.relationships
+    columns = [getattr(User, attr)
+               for attr in SESSION_USER_COLUMNS + attrs
+               if attr not in relationships]
+    options = [selectinload(getattr(User, attr))
+               for attr in attrs
+               if attr in relationships]
+
+    return (User
+            .query
+            .options(load_only(*columns), *options)
+            .filter(User.id == user_id)
+            .first())
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        view = app.view_functions.get(request.endpoint)
+        g.user = load_session_user(session[CURR_USER_KEY],
+                                   getattr(view, 'user_attrs', ()))
 
     else:
         g.user = None
 
 
+@app.before_request
+def serve_cached_response():
+    """Serve anonymous GETs of @cacheable views from the response cache."""
+
+    view = app.view_functions.get(request.endpoint)
+
+    # pages rendered with flashed messages are for one visitor only
+    g.cacheable = (request.method == 'GET' and g.user is None and
+                   hasattr(view, 'cache_max_age') and
+                   '_flashes' not in session)
+
+    if not g.cacheable:
+        return None
+
+    g.render_started = time.monotonic()
+    cached = responses.get(request.full_path)
+
+    if cached is None:
+        return None
+
+    data, mimetype, last_modified = cached
+    response = app.response_class(data, mimetype=mimetype)
+    response.last_modified = last_modified
+    g.cacheable = False  # already cached
+    return response
+
+
+# normalized username (as the rate limiter counts it) -> digests of the
+# username/password pairs that just failed to log in as it; a repeat of one
+# is turned away without a user lookup or a bcrypt check
+failed_logins = TTLCache(maxsize=10000,
+                         ttl=app.config['FAILED_LOGIN_CACHE_TTL'])
+
+# Keys the digests, so the cache never holds plain password hashes
+FAILED_LOGIN_KEY = os.urandom(32)
+
+
+def login_digest(username, password):
+    """Keyed digest of a login attempt for the failed login cache.
+
+    Covers the username as typed, since logins match it exactly.
+    """
+
+    attempt = f"{username}\0{password}".encode('UTF-8')
+
+    return hmac.new(FAILED_LOGIN_KEY, attempt, hashlib.sha256).digest()
+
+
 def do_login(user):
     """Log in user."""
 
@@ -56,6 +339,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@rate_limited
 def signup():
     """Handle user signup.
 
@@ -83,6 +367,8 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        # passwords that failed before the account existed may work now
+        failed_logins.pop(normalize_username(user.username))
         do_login(user)
 
         return redirect("/")
@@ -92,20 +378,30 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@rate_limited
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        username = form.username.data
+        digest = login_digest(username, form.password.data)
+        failed = failed_logins.get(normalize_username(username), frozenset())
+
+        if digest in failed:
+            user = False
+        else:
+            user = User.authenticate(username, form.password.data)
 
         if user:
+            # saves the password's new hash if authenticate rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
+        failed_logins.set(normalize_username(username), failed | {digest})
         flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
@@ -123,44 +419,68 @@ def logout():
 ##############################################################################
 # General user routes:
 
+def following_ids_among(users):
+    """Ids of `users` the current user follows (empty if logged out)."""
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids_among([user.id for user in users])
+
+
+def liked_ids_among(messages):
+    """Ids of `messages` the current user likes (empty if logged out)."""
+
+    if not g.user:
+        return set()
+
+    return Likes.liked_among(g.user.id, [msg.id for msg in messages])
+
+
 @app.route('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search users by username, bio
+    and location (best matches first), and a 'page' param to page through
+    the results.
     """
 
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['USERS_PAGE_SIZE']
 
     if not search:
-        users = User.query.all()
+        query = User.query.order_by(User.id)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        query = search_users(search)
 
-    return render_template('users/index.html', users=users)
+    # Fetch one extra user to find out whether there's another page
+    users = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    has_next = len(users) > per_page
+    users = users[:per_page]
+
+    return render_template('users/index.html', users=users,
+                           following_ids=following_ids_among(users),
+                           search=search, page=page, has_next=has_next)
 
 
 @app.route('/users/<int:user_id>')
+@cacheable(max_age=30)
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
+    cache_tags(f"user:{user_id}")
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-
-    if g.user:
-        liked_msg_ids = [msg.id for msg in g.user.likes]
-    else:
-        liked_msg_ids = None
+    messages, next_cursor = paginate_messages(
+        Message.query.filter(Message.user_id == user_id))
 
-    return render_template('users/show.html', user=user, messages=messages, likes=liked_msg_ids)
+    return render_template('users/show.html', user=user, messages=messages,
+                           likes=liked_ids_among(messages),
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -172,7 +492,8 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html', user=user,
+                           following_ids=following_ids_among(user.following))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -184,7 +505,8 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return render_template('users/followers.html', user=user,
+                           following_ids=following_ids_among(user.followers))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -196,8 +518,12 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    db.session.add(Follows(user_being_followed_id=followed_user.id,
+                           user_following_id=g.user.id))
+    enqueue('backfill_timeline', g.user.id, followed_user.id)
     db.session.commit()
+    # both users' follow counts changed
+    responses.invalidate(f"user:{g.user.id}", f"user:{followed_user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -210,14 +536,17 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    follow = Follows.query.get_or_404((follow_id, g.user.id))
+    db.session.delete(follow)
+    enqueue('prune_timeline', g.user.id, follow_id)
     db.session.commit()
+    responses.invalidate(f"user:{g.user.id}", f"user:{follow_id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@loads_user('email', 'bio', 'password')
 def profile():
     """Update profile for current user."""
 
@@ -232,6 +561,7 @@ def profile():
         # User needs to enter password to authenticate
 
         if User.authenticate(user.username, form.password.data):
+            old_username = user.username
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data
@@ -239,6 +569,12 @@ def profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            session_users.pop(user.id)
+            # failures at either name were for another account (or none)
+            for username in (old_username, user.username):
+                failed_logins.pop(normalize_username(username))
+            # their messages' pages show their name and picture too
+            responses.invalidate(f"user:{user.id}")
             flash("Profile updated", "success")
             return redirect(f"/users/{user.id}")
 
@@ -256,7 +592,23 @@ def get_user_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template("users/likes.html", user=user, likes=user.likes)
+
+    # newest like first, paged on the likes(user_id, id) index
+    try:
+        rows, next_cursor = paginate_by_id(
+            Message
+            .with_authors()
+            .join(Likes, Likes.message_id == Message.id)
+            .filter(Likes.user_id == user_id),
+            Likes.id,
+            before=request.args.get('before'),
+            per_page=app.config['FEED_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+
+    return render_template("users/likes.html", user=user,
+                           likes=[row.Message for row in rows],
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/delete', methods=["POST"])
@@ -268,9 +620,27 @@ def delete_user():
         return redirect("/")
 
     do_logout()
+    session_users.pop(g.user.id)
+
+    # Users whose counters include this user's follows and messages' likes;
+    # the database cascades those rows away without the ORM noticing.
+    related_ids = {
+        user_id
+        for (user_id,) in db.session.query(Follows.user_following_id).filter(
+            Follows.user_being_followed_id == g.user.id).union(
+            db.session.query(Follows.user_being_followed_id).filter(
+                Follows.user_following_id == g.user.id),
+            db.session.query(Likes.user_id)
+            .join(Message, Message.id == Likes.message_id)
+            .filter(Message.user_id == g.user.id))
+    }
 
     db.session.delete(g.user)
+    db.session.flush()
+    User.refresh_counters(related_ids)
     db.session.commit()
+    responses.invalidate(f"user:{g.user.id}",
+                         *(f"user:{user_id}" for user_id in related_ids))
 
     return redirect("/signup")
 
@@ -292,28 +662,61 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        post_message(g.user.id, form.text.data)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search', methods=["GET"])
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param in querystring of words to search for; results are
+    best matches first, a page at a time with a `before` cursor.
+    """
+
+    search = request.args.get('q', '')
+
+    try:
+        messages, next_cursor = search_messages(
+            search,
+            before=request.args.get('before'),
+            per_page=app.config['FEED_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+
+    return render_template('messages/search.html', search=search,
+                           messages=messages, likes=liked_ids_among(messages),
+                           next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@cacheable(max_age=60)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = Message.with_authors().get_or_404(message_id)
+    cache_tags(f"message:{msg.id}", f"user:{msg.user_id}")
     return render_template('messages/show.html', message=msg)
 
 
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def toggle_message_like(message_id):
-    """Toggles if user likes/unlikes message"""
+    """Toggles if user likes/unlikes message
+
+    Responds with JSON (`{"message_id": ..., "liked": ...}`) instead of a
+    redirect when the request asks for it, so the like button can update
+    in place.
+    """
+
+    wants_json = request.accept_mimetypes.best == 'application/json'
 
     if not g.user:
+        if wants_json:
+            return jsonify(error="Access unauthorized."), 401
+
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
@@ -322,17 +725,14 @@ def toggle_message_like(message_id):
     # if liked_message.user_id == g.user.id:
     #     return abort(403)
 
-    # store previous user likes
-    user_likes = g.user.likes
+    liked = Likes.toggle(g.user.id, liked_message.id)
+    db.session.commit()
+    # the liker's like count changed
+    responses.invalidate(f"user:{g.user.id}")
 
-    # if user unlikes message, remove from g.user.likes
-    if liked_message in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_message]
-    else:
-        # else append liked_message to g.user.likes
-        g.user.likes.append(liked_message)
+    if wants_json:
+        return jsonify(message_id=liked_message.id, liked=liked)
 
-    db.session.commit()
     return redirect("/")
 
 
@@ -350,8 +750,7 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
-    db.session.commit()
+    delete_message(msg)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -360,45 +759,131 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
+# Counter columns shown in the home page sidebar
+SIDEBAR_COUNTERS = ('messages_count', 'following_count', 'followers_count')
+
+
+def timeline_page(user_id, before, per_page):
+    """One page of `user_id`'s home timeline: `(messages, next_cursor)`."""
+
+    return paginate(TimelineEntry.messages_for(user_id),
+                    TimelineEntry.timestamp,
+                    TimelineEntry.message_id,
+                    before=before, per_page=per_page)
+
+
+def timeline_page_likes(user_id, before, per_page):
+    """Ids of the messages on that page of `user_id`'s timeline they like.
+
+    Selects the page's message ids itself, so it doesn't have to wait for
+    timeline_page.
+    """
+
+    page = page_query(db.session
+                      .query(TimelineEntry.message_id)
+                      .filter(TimelineEntry.user_id == user_id),
+                      TimelineEntry.timestamp,
+                      TimelineEntry.message_id,
+                      before, per_page)
+
+    rows = (db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == user_id,
+                    Likes.message_id.in_(page.subquery())))
+
+    return {message_id for (message_id,) in rows}
+
+
+def sidebar_counters(user_id):
+    """`user_id`'s SIDEBAR_COUNTERS, by name."""
+
+    row = (db.session
+           .query(*(getattr(User, col) for col in SIDEBAR_COUNTERS))
+           .filter(User.id == user_id)
+           .one())
+
+    return dict(zip(SIDEBAR_COUNTERS, row))
+
+
 @app.route('/')
+@cacheable(max_age=300)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+
+    The timeline page, likes and counters are fetched at once when
+    FEED_PARALLEL_FETCH is on.
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        args = (g.user.id, request.args.get('before'),
+                app.config['FEED_PAGE_SIZE'])
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        try:
+            (messages, next_cursor), likes, counters = fetcher.fetch(
+                (timeline_page, *args),
+                (timeline_page_likes, *args),
+                (sidebar_counters, g.user.id))
+        except ValueError:
+            abort(400)
 
-        liked_msg_ids = [msg.id for msg in g.user.likes]
+        # no-ops for the request's own objects, when fetched in turn
+        messages = [db.session.merge(msg, load=False) for msg in messages]
+        for attr, value in counters.items():
+            set_committed_value(g.user, attr, value)
 
-        return render_template('home.html', messages=messages, likes=liked_msg_ids)
+        return render_template('home.html', messages=messages,
+                               likes=likes, next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# HTTP caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages of @cacheable views carry an ETag and Last-Modified, so browsers and
+# CDNs can revalidate them and get a 304. Anonymous visitors' copies may be
+# reused for the view's max_age; logged-in users' copies are private and
+# always revalidated. Other pages aren't cached at all; static files keep
+# Flask's own caching headers.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(resp):
+    """Add caching headers, and store cacheable anonymous pages."""
+
+    if request.endpoint == 'static':
+        # send_file already set its own ETag and max-age
+        return resp
+
+    view = app.view_functions.get(request.endpoint)
+    max_age = getattr(view, 'cache_max_age', None)
+
+    if (max_age is None or request.method != 'GET' or
+            resp.status_code != 200 or resp.direct_passthrough):
+        resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        resp.headers["Pragma"] = "no-cache"
+        resp.headers["Expires"] = "0"
+        return resp
+
+    if resp.last_modified is None:
+        resp.last_modified = datetime.utcnow().replace(microsecond=0)
+
+    if g.get('cacheable'):
+        responses.set(request.full_path,
+                      (resp.get_data(), resp.mimetype, resp.last_modified),
+                      tags=frozenset(g.get('cache_tags', ())),
+                      since=g.render_started)
+
+    if g.get('user') is None:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = max_age
+    else:
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+
+    resp.vary.add('Cookie')
+    resp.add_etag()
+    return resp.make_conditional(request)
@@ -0,0 +1,129 @@
+"""Microbenchmarks of the User model's hot methods.
+
+Each one runs against follow graphs of 10 to 100,000 edges, so a method
+whose cost grows with the number of follows (or likes) shows up as a curve
+across sizes instead of one flat number. Needs pytest-benchmark (in
+requirements-dev.txt); runs against a throwaway SQLite database, offline:
+
+    (venv) $ pip install -r requirements-dev.txt
+    (venv) $ python -m pytest benchmarks/bench_models.py \\
+        --benchmark-autosave --benchmark-compare
+
+--benchmark-compare diffs against the last saved run.
+"""
+
+import itertools
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+# the app connects to DATABASE_URL when it's imported
+DATABASE_DIR = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = (
+    f"sqlite:///{os.path.join(DATABASE_DIR.name, 'bench.db')}")
+
+from app import app  # noqa: E402
+from models import db, hasher, User, Message, Follows, Likes  # noqa: E402
+
+# The cheapest bcrypt cost, so authenticate/signup time the rest of the work
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+# Follow edges in each graph benchmarked
+GRAPH_SIZES = [10, 1000, 100000]
+
+# Rows per executemany when building a graph
+BATCH_SIZE = 10000
+
+
+def insert(table, rows):
+    """Insert `rows` (dicts) into `table`, a batch at a time."""
+
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+@pytest.fixture(scope='module', params=GRAPH_SIZES,
+                ids=lambda edges: f"{edges}-edges")
+def hub(request):
+    """A graph of `edges` follows, half of them of user 1 (the hub) by
+    everyone else and half by the hub of everyone else; the hub also likes
+    one message by each other user. Returns the hub's id."""
+
+    others = max(request.param // 2, 1)
+    password = hasher.generate('password')
+
+    db.drop_all()
+    db.create_all()
+
+    insert(User.__table__, [
+        {'username': f"user{n}", 'email': f"user{n}@test.com",
+         'password': password}
+        for n in range(1, others + 2)])
+    insert(Follows.__table__, [
+        {'user_being_followed_id': 1, 'user_following_id': n}
+        for n in range(2, others + 2)])
+    insert(Follows.__table__, [
+        {'user_being_followed_id': n, 'user_following_id': 1}
+        for n in range(2, others + 2)])
+    insert(Message.__table__, [
+        {'text': f"message by user{n}", 'user_id': n}
+        for n in range(2, others + 2)])
+    insert(Likes.__table__, [
+        {'user_id': 1, 'message_id': n}
+        for n in range(1, others + 1)])
+    db.session.commit()
+
+    yield 1
+
+    db.session.rollback()
+    db.drop_all()
+
+
+@pytest.fixture
+def user(hub):
+    """The hub, loaded into a fresh session."""
+
+    db.session.remove()
+    yield User.query.get(hub)
+    db.session.rollback()
+
+
+def test_is_following(benchmark, user):
+    last = User.query.order_by(User.id.desc()).first()
+
+    assert benchmark(user.is_following, last)
+
+
+def test_is_followed_by(benchmark, user):
+    last = User.query.order_by(User.id.desc()).first()
+
+    assert benchmark(user.is_followed_by, last)
+
+
+def test_authenticate(benchmark, user):
+    assert benchmark(User.authenticate, 'user1', 'password')
+
+
+def test_signup(benchmark, user):
+    ids = itertools.count()
+
+    def signup():
+        n = next(ids)
+        User.signup(f"new{n}", f"new{n}@test.com", 'password', None)
+        db.session.flush()
+
+    benchmark(signup)
+
+
+@pytest.mark.parametrize('relationship', ['followers', 'following', 'likes'])
+def test_load_relationship(benchmark, user, relationship):
+    """Load every user in a relationship of the hub's."""
+
+    def load():
+        db.session.expire(user, [relationship])
+        return len(getattr(user, relationship))
+
+    assert benchmark(load) >= 1
@@ -0,0 +1,471 @@
+"""Load test Warbler's pages with a mix of realistic traffic.
+
+Seeds a database with generated data, then has a number of simulated users
+log in and browse: reading their home feed and other users' profiles,
+following and unfollowing, liking and posting. Reports requests per second
+and p50/p95/p99 latency per route, and can save them as a baseline for a
+later run to be compared against:
+
+    (venv) $ python benchmarks/loadtest.py --save /tmp/before.json
+    (venv) $ git checkout my-branch
+    (venv) $ python benchmarks/loadtest.py --reuse --compare /tmp/before.json
+
+Comparing exits with status 1 if any route's p95 got more than --tolerance
+slower (among routes with at least MIN_COMPARED requests in both runs).
+Compare runs made on the same machine, database and sizes.
+
+Requests go through Flask's test client by default, which times the app
+alone; --server runs a local threaded WSGI server and goes through HTTP
+instead. The login rate limits and CSRF checks are turned off, as in the
+tests. A response only counts as a success if it's the one a logged-in user
+gets (a redirect to where the action goes, not back to the home page), and a
+simulated user whose login fails starts over instead of browsing logged out.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+from urllib.request import (HTTPCookieProcessor, HTTPRedirectHandler,
+                            Request, build_opener)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Relative weights of what a logged-in user does next
+ACTIONS = {
+    'home': 40,
+    'profile': 25,
+    'like': 15,
+    'follow': 10,
+    'post': 10,
+}
+
+# Actions a user takes before logging out and starting over as another user
+SESSION_LENGTH = 20
+
+# Fewest requests to a route for its percentiles to be compared
+MIN_COMPARED = 20
+
+
+class TestClientSession:
+    """A browser session going through Flask's test client."""
+
+    def __init__(self, app, remote_addr):
+        self.client = app.test_client()
+        self.environ = {'REMOTE_ADDR': remote_addr}
+
+    def request(self, method, path, data=None, headers=None):
+        """`(status code, redirect path)` of the response to `method path`."""
+
+        resp = self.client.open(path, method=method, data=data,
+                                headers=headers, environ_base=self.environ)
+        resp.close()
+
+        return resp.status_code, redirect_path(resp.headers.get('Location'))
+
+
+class NoRedirects(HTTPRedirectHandler):
+    """Report redirects instead of following them."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPSession:
+    """A browser session going over HTTP to `base_url`."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()),
+                                   NoRedirects())
+
+    def request(self, method, path, data=None, headers=None):
+        """`(status code, redirect path)` of the response to `method path`."""
+
+        body = urlencode(data or {}).encode() if method == 'POST' else None
+        req = Request(self.base_url + path, body, headers=headers or {},
+                      method=method)
+
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status, None
+        except HTTPError as error:
+            error.read()
+            return error.code, redirect_path(error.headers.get('Location'))
+
+
+def redirect_path(location):
+    """The path a Location header points to, or None without one."""
+
+    return urlsplit(location).path if location else None
+
+
+class Results:
+    """Latencies and errors of the requests made, by route."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+    def count(self):
+        with self._lock:
+            return sum(len(times) for times in self.latencies.values())
+
+
+def percentile(times, fraction):
+    """The `fraction` percentile of the sorted `times` (nearest rank)."""
+
+    return times[max(math.ceil(fraction * len(times)) - 1, 0)]
+
+
+def summarize(times, errors, elapsed):
+    """Stats of one route's request `times`, in milliseconds."""
+
+    times = sorted(times)
+
+    return {
+        'requests': len(times),
+        'errors': errors,
+        'requests_per_second': round(len(times) / elapsed, 1),
+        'mean_ms': round(1000 * sum(times) / len(times), 2),
+        'p50_ms': round(1000 * percentile(times, 0.50), 2),
+        'p95_ms': round(1000 * percentile(times, 0.95), 2),
+        'p99_ms': round(1000 * percentile(times, 0.99), 2),
+    }
+
+
+class VirtualUser:
+    """A simulated user, clicking around until there are enough requests.
+
+    `data` is what load_data() found in the database; its `following` is
+    kept up to date as users follow and unfollow.
+    """
+
+    def __init__(self, session, data, results, rng):
+        self.session = session
+        self.data = data
+        self.results = results
+        self.rng = rng
+        self.user_id = None
+
+    def request(self, route, method, path, data=None, headers=None,
+                redirect=None):
+        """Make a request; returns whether it succeeded.
+
+        With `redirect`, success is a redirect to that path; otherwise, a
+        200. Views redirect users who aren't logged in back to the home
+        page, so a redirect elsewhere than expected is an error.
+        """
+
+        start = time.perf_counter()
+        status, location = self.session.request(method, path, data, headers)
+
+        if redirect is None:
+            ok = status == 200
+        else:
+            ok = status == 302 and location == redirect
+
+        self.results.record(route, time.perf_counter() - start, ok)
+
+        return ok
+
+    def log_in(self):
+        """Log in as a random user; returns whether it worked."""
+
+        self.user_id, username = self.rng.choice(self.data['users'])
+
+        return self.request('POST /login', 'POST', '/login',
+                            {'username': username, 'password': 'password'},
+                            redirect='/')
+
+    def home(self):
+        self.request('GET /', 'GET', '/')
+
+    def profile(self):
+        user_id, _ = self.rng.choice(self.data['users'])
+        self.request('GET /users/<id>', 'GET', f'/users/{user_id}')
+
+    def like(self):
+        message_id = self.rng.randint(1, self.data['messages'])
+        # as the like button does, so a logged-out like is a 401
+        self.request('POST /messages/<id>/like', 'POST',
+                     f'/messages/{message_id}/like',
+                     headers={'Accept': 'application/json'})
+
+    def follow(self):
+        other_id, _ = self.rng.choice(self.data['users'])
+        following = self.data['following'][self.user_id]
+
+        if other_id == self.user_id:
+            return
+
+        if other_id in following:
+            following.discard(other_id)
+            self.request('POST /users/stop-following/<id>', 'POST',
+                         f'/users/stop-following/{other_id}',
+                         redirect=f'/users/{self.user_id}/following')
+        else:
+            following.add(other_id)
+            self.request('POST /users/follow/<id>', 'POST',
+                         f'/users/follow/{other_id}',
+                         redirect=f'/users/{self.user_id}/following')
+
+    def post(self):
+        self.request('POST /messages/new', 'POST', '/messages/new',
+                     {'text': f"Load test message {self.rng.random()}"},
+                     redirect=f'/users/{self.user_id}')
+
+    def run(self, total):
+        actions = list(ACTIONS)
+        weights = list(ACTIONS.values())
+
+        while self.results.count() < total:
+            if not self.log_in():
+                continue
+
+            for _ in range(SESSION_LENGTH):
+                getattr(self, self.rng.choices(actions, weights)[0])()
+
+            self.request('GET /logout', 'GET', '/logout', redirect='/')
+
+
+def generate_and_seed(args):
+    """Fill the database with generated data of the requested sizes."""
+
+    from seed import seed  # imports the app, so after DATABASE_URL is set
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+             '--users', str(args.users), '--messages', str(args.messages),
+             '--follows', str(args.follows), '--likes', str(args.likes),
+             '--seed', args.seed, '--out-dir', data_dir],
+            check=True)
+
+        seed(data_dir)
+
+
+def load_data():
+    """What virtual users need to know about the database."""
+
+    from models import db, User, Message, Follows
+
+    following = defaultdict(set)
+    for followed_id, follower_id in db.session.query(
+            Follows.user_being_followed_id, Follows.user_following_id):
+        following[follower_id].add(followed_id)
+
+    data = {
+        'users': db.session.query(User.id, User.username).all(),
+        'messages': db.session.query(db.func.max(Message.id)).scalar() or 0,
+        'following': following,
+    }
+    db.session.remove()
+
+    return data
+
+
+def start_server(app):
+    """Serve `app` from a local threaded WSGI server; returns its URL."""
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def run(args):
+    """Drive the traffic; returns the results, ready to save as JSON."""
+
+    from app import app
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    # a few clients log in far more often than the limits allow
+    app.config['RATE_LIMIT_PER_IP'] = 0
+    app.config['RATE_LIMIT_PER_USERNAME'] = 0
+
+    if args.server:
+        base_url = start_server(app)
+
+    data = load_data()
+    if not data['users'] or not data['messages']:
+        sys.exit("The database has no users or messages; drop --reuse")
+
+    results = Results()
+    threads = []
+
+    for n in range(args.clients):
+        if args.server:
+            session = HTTPSession(base_url)
+        else:
+            session = TestClientSession(app, f"10.0.{n // 250}.{n % 250 + 1}")
+
+        user = VirtualUser(session, data, results,
+                           random.Random(f"{args.seed}-{n}"))
+        threads.append(threading.Thread(target=user.run,
+                                        args=(args.requests,)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    every = [t for times in results.latencies.values() for t in times]
+
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'database': args.database_url.split(':', 1)[0],
+            'via': 'http' if args.server else 'test client',
+            'clients': args.clients,
+            'users': args.users,
+            'messages': args.messages,
+            'follows': args.follows,
+            'likes': args.likes,
+            'seconds': round(elapsed, 2),
+        },
+        'total': summarize(every, sum(results.errors.values()), elapsed),
+        'routes': {route: summarize(times, results.errors[route], elapsed)
+                   for route, times in sorted(results.latencies.items())},
+    }
+
+
+def git_commit():
+    """Short hash of the checked-out commit, if there is one."""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"\n{'route':<34} {'reqs':>6} {'errs':>5} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+
+    for route, stats in list(results['routes'].items()) + [
+            ('all', results['total'])]:
+        print(f"{route:<34} {stats['requests']:>6} {stats['errors']:>5} "
+              f"{stats['requests_per_second']:>8} {stats['p50_ms']:>8} "
+              f"{stats['p95_ms']:>8} {stats['p99_ms']:>8}")
+
+
+def compare(baseline, results, tolerance):
+    """Print how each route's latency changed since `baseline`; returns
+    the routes whose p95 got more than `tolerance` (a fraction) slower."""
+
+    regressions = []
+
+    print(f"\nCompared to {baseline['meta'].get('commit')} "
+          f"({baseline['meta'].get('date')}):")
+    print(f"{'route':<34} {'p50':>8} {'p95':>8} {'p99':>8}")
+
+    for route, stats in results['routes'].items():
+        before = baseline['routes'].get(route)
+
+        if before is None:
+            print(f"{route:<34} (new)")
+            continue
+
+        changes = [(stats[key] - before[key]) / max(before[key], 1e-9)
+                   for key in ('p50_ms', 'p95_ms', 'p99_ms')]
+        flag = ''
+
+        if min(stats['requests'], before['requests']) < MIN_COMPARED:
+            flag = '  (too few requests to tell)'
+        elif changes[1] > tolerance:
+            regressions.append(route)
+            flag = '  SLOWER'
+
+        print(f"{route:<34} " +
+              " ".join(f"{change:>+8.0%}" for change in changes) + flag)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url',
+                        default='sqlite:////tmp/warbler-bench.db',
+                        help="database to seed and test against (default: "
+                             "sqlite:////tmp/warbler-bench.db)")
+    parser.add_argument('--reuse', action='store_true',
+                        help="test against the database as it is, "
+                             "without seeding it")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--seed', default='warbler',
+                        help="seed of the data and traffic (default: warbler)")
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="requests to make in all, finishing the sessions "
+                             "under way (default: 2000)")
+    parser.add_argument('--clients', type=int, default=4,
+                        help="users making requests at once (default: 4)")
+    parser.add_argument('--server', action='store_true',
+                        help="go over HTTP to a local WSGI server")
+    parser.add_argument('--save', metavar='PATH',
+                        help="save the results as JSON, as a baseline")
+    parser.add_argument('--compare', metavar='PATH',
+                        help="compare the results to a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="fraction a route's p95 may grow by before "
+                             "it's a regression (default: 0.2)")
+    args = parser.parse_args()
+
+    # the app connects to DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = args.database_url
+    sys.path.insert(0, ROOT)
+
+    if not args.reuse:
+        generate_and_seed(args)
+
+    results = run(args)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
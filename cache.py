@@ -0,0 +1,148 @@
+"""Small in-process caches for Warbler."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    The cache is process-local: every worker keeps its own copy, so anything
+    stored here can be up to `ttl` seconds stale in the *other* workers after
+    it is invalidated in one. A `ttl` of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the live value stored for `key`, or `default`."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return default
+
+            expires, value = entry
+
+            if expires < time.monotonic():
+                self._remove(key)
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store `value` for `key`, evicting the least recently used entry
+        if the cache is full."""
+
+        if not self.ttl:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def pop(self, key):
+        """Invalidate `key`."""
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        """Drop the entry for `key`; called with the lock held."""
+
+        del self._entries[key]
+
+    def clear(self):
+        """Invalidate everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+class TaggedCache(TTLCache):
+    """TTLCache whose entries can also be invalidated by tag.
+
+    Tag each entry with what it was built from (say `'user:1'`), then
+    invalidate the tag when that changes:
+
+        pages.set('/users/1', page, tags=['user:1'], since=started)
+        ...
+        pages.invalidate('user:1')
+
+    `since` is when building the entry started. If one of its tags was
+    invalidated after that, the entry may be built from data the
+    invalidation was meant to replace, so it isn't stored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        super().__init__(maxsize, ttl)
+        self._tags = {}
+        self._keys_by_tag = {}
+        # tag -> when it was last invalidated; only compared with entries
+        # built within the last `ttl` seconds
+        self._invalidated = TTLCache(maxsize, ttl)
+
+    def set(self, key, value, tags=(), since=None):
+        """Store `value` for `key`, tagged with `tags`, unless one of them
+        was invalidated since `since` (a time.monotonic() reading)."""
+
+        if not self.ttl:
+            return
+
+        with self._lock:
+            if since is not None and any(
+                    self._invalidated.get(tag, since) > since
+                    for tag in tags):
+                return
+
+            self.pop(key)
+            super().set(key, value)
+
+            # storing it may have evicted it again right away
+            if key in self._entries:
+                self._tags[key] = tags
+                for tag in tags:
+                    self._keys_by_tag.setdefault(tag, set()).add(key)
+
+    def invalidate(self, *tags):
+        """Invalidate every entry tagged with one of `tags`."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            for tag in tags:
+                self._invalidated.set(tag, now)
+
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def _remove(self, key):
+        super()._remove(key)
+
+        for tag in self._tags.pop(key, ()):
+            keys = self._keys_by_tag[tag]
+            keys.discard(key)
+
+            if not keys:
+                del self._keys_by_tag[tag]
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._tags.clear()
+            self._keys_by_tag.clear()
+            self._invalidated.clear()
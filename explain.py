@@ -0,0 +1,136 @@
+"""Print query plans for the queries Warbler's pages depend on.
+
+Run it against a database with realistic data before deploying:
+
+    (venv) $ flask explain
+
+A plan that switches from an index search to a full scan of a big table is
+a regression.
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, func
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from search import search_users
+
+# How each dialect asks for a plan instead of running the statement
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+
+def explain_sql(cursor, dialect, statement, parameters):
+    """Plan for a raw SQL `statement`, as a list of lines.
+
+    `cursor` is a DBAPI cursor; the statement is never actually run.
+    Returns an empty list for dialects we can't explain.
+    """
+
+    prefix = EXPLAIN_PREFIXES.get(dialect)
+
+    if prefix is None:
+        return []
+
+    cursor.execute(prefix + statement, parameters)
+
+    if dialect == 'sqlite':
+        # rows are (id, parent, notused, detail)
+        return [row[-1] for row in cursor.fetchall()]
+
+    return [row[0] for row in cursor.fetchall()]
+
+
+def explain_query(query):
+    """Plan for an ORM `query`, as a list of lines."""
+
+    def explain_instead(conn, cursor, statement, parameters, context,
+                        executemany):
+        return EXPLAIN_PREFIXES[conn.dialect.name] + statement, parameters
+
+    with db.engine.connect() as conn:
+        if conn.dialect.name not in EXPLAIN_PREFIXES:
+            return []
+
+        event.listen(conn, 'before_cursor_execute', explain_instead,
+                     retval=True)
+        rows = conn.execute(query.statement).cursor.fetchall()
+
+    if conn.dialect.name == 'sqlite':
+        return [row[-1] for row in rows]
+
+    return [row[0] for row in rows]
+
+
+def hot_queries(user_id, page_size=20):
+    """The queries behind the main pages, keyed by a description.
+
+    These mirror the queries built in app.py, with `user_id` standing in for
+    both the viewer and the user being viewed.
+    """
+
+    some_ids = list(range(user_id, user_id + page_size))
+
+    return {
+        "home timeline page": (
+            TimelineEntry
+            .messages_for(user_id)
+            .order_by(TimelineEntry.timestamp.desc(),
+                      TimelineEntry.message_id.desc())
+            .limit(page_size)),
+        "profile messages page": (
+            Message
+            .query
+            .filter(Message.user_id == user_id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(page_size)),
+        "likes page": (
+            Message
+            .with_authors()
+            .join(Likes, Likes.message_id == Message.id)
+            .filter(Likes.user_id == user_id)
+            .order_by(Likes.id.desc())
+            .limit(page_size)),
+        "liked state of a page": (
+            db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == user_id, Likes.message_id.in_(some_ids))),
+        "follow state of a page": (
+            db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    Follows.user_being_followed_id.in_(some_ids))),
+        "following list": (
+            User
+            .query
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id)),
+        "followers list": (
+            User
+            .query
+            .join(Follows, Follows.user_following_id == User.id)
+            .filter(Follows.user_being_followed_id == user_id)),
+        "login lookup": (
+            User.query.filter(User.username == 'someone')),
+        "user search page": (
+            search_users("some").limit(page_size)),
+    }
+
+
+@click.command('explain')
+@click.option('--user-id', type=int, default=None,
+              help="User to plan the queries for (default: the first one).")
+@with_appcontext
+def explain_command(user_id):
+    """Print the query plan of each of the app's hot queries."""
+
+    if user_id is None:
+        user_id = db.session.query(func.min(User.id)).scalar() or 1
+
+    for description, query in hot_queries(user_id).items():
+        click.echo(f"== {description}")
+        for line in explain_query(query):
+            click.echo(f"   {line}")
+        click.echo()
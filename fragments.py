@@ -0,0 +1,62 @@
+"""Template fragment caching for Warbler.
+
+Message and user cards look the same to every viewer apart from their
+like/follow buttons, so the rest of each card is rendered once and reused:
+
+    {% cache 'message-card', msg.id, msg.timestamp, msg.user.updated_at %}
+      ...
+    {% endcache %}
+
+The arguments make up the cache key. Include a version that changes
+whenever anything the fragment shows does (`User.updated_at` for cards), so
+cached fragments never need invalidating, and enough to tell rows apart
+when an id is reused (SQLite reuses the highest id after a delete, hence
+`msg.timestamp`). Keep anything that depends on the viewer outside the
+block.
+"""
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the `{% cache *key %}...{% endcache %}` tag.
+
+    Fragments are stored in the environment's `fragment_cache` (anything
+    with TTLCache's get/set); without one, blocks are always rendered.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.Tuple(key, 'load')]),
+            [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        """The fragment cached for `key`, rendering it if there's none."""
+
+        cache = self.environment.fragment_cache
+
+        if cache is None:
+            return caller()
+
+        fragment = cache.get(key)
+
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+
+        return fragment
@@ -2,27 +2,53 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    $ python generator/create_csvs.py --users 1000000 --follows 10000000 \\
+        --messages 5000000 --likes 5000000 --processes 8
+
+The output only depends on the sizes and --seed, not on --processes. Nothing
+is fetched over the network.
+
+How many followers a user has follows a power law (a few users are followed
+by a big share of everyone, most by a handful), and so does how many likes
+a message gets. Rows are generated in fixed-size parts, each by one worker
+process, and the parts are joined into one file per table. Follows and likes
+are parted by follower/liker, so each part can drop its duplicate pairs
+with a set of just its own pairs.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import math
+import os
+import random
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import HEADER_IMAGE_URLS, get_random_datetime, PowerLawSampler
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+# Rows of users/messages generated per part
+ROWS_PER_PART = 100000
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Pairs of follows/likes generated per part (each part keeps a set of them)
+PAIRS_PER_PART = 1000000
 
-fake = Faker()
+# Power-law draws per pair a part makes before drawing the rest uniformly
+MAX_DRAWS_PER_PAIR = 20
+
+# Every user's password is "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +58,227 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def part_rng(args, kind, part):
+    """Random generator for one part; the same for every run with the same
+    seed, however the parts are spread over processes."""
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+    return random.Random(f"{args.seed}-{kind}-{part}")
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+
+def write_users(args, part, first, last, writer):
+    """Write users `first` to `last` (ids, inclusive)."""
+
+    rng = part_rng(args, 'users', part)
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    for user_id in range(first, last + 1):
+        # suffixed with the id, since usernames and emails must be unique
+        username = f"{fake.user_name()}{user_id}"
+
+        writer.writerow(dict(
+            email=f"{username}@{fake.free_email_domain()}",
+            username=username,
+            image_url=rng.choice(image_urls),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(HEADER_IMAGE_URLS),
             location=fake.city()
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def write_messages(args, part, first, last, writer):
+    """Write messages `first` to `last` (ids, inclusive)."""
+
+    rng = part_rng(args, 'messages', part)
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    for _ in range(first, last + 1):
+        writer.writerow(dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+            timestamp=get_random_datetime(rng=rng, now=args.now),
+            user_id=rng.randint(1, args.users)
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def write_pairs(args, kind, part, first, last, writer):
+    """Write the follows (or likes) of users `first` to `last` (ids,
+    inclusive), their share of all of them.
+
+    Who's followed (what's liked) is drawn from a power law; who's following
+    (liking) uniformly. Duplicate pairs and self-follows are redrawn.
+
+    With a steep power law and many pairs, most draws land on pairs already
+    drawn, so after MAX_DRAWS_PER_PAIR draws per pair the rest are drawn
+    uniformly instead. main() keeps every part at most about half full, so
+    those take two draws each on average.
+    """
+
+    rng = part_rng(args, kind, part)
+
+    if kind == 'follows':
+        total, targets = args.follows, args.users
+    else:
+        total, targets = args.likes, args.messages
+
+    sampler = PowerLawSampler(targets, args.exponent)
+    # this part's share of the pairs (rounded so the shares add up to total)
+    count = (round(total * last / args.users) -
+             round(total * (first - 1) / args.users))
+    seen = set()
+    max_draws = MAX_DRAWS_PER_PAIR * count
+    draws = uniform = 0
+
+    while len(seen) < count:
+        source = rng.randint(first, last)
+        draws += 1
+
+        if draws <= max_draws:
+            target = sampler.sample(rng)
+        else:
+            target = rng.randint(1, targets)
+
+        if kind == 'follows' and source == target:
+            continue
+
+        pair = source * (targets + 1) + target
+        if pair in seen:
+            continue
+
+        seen.add(pair)
+        uniform += draws > max_draws
+
+        if kind == 'follows':
+            writer.writerow(dict(user_being_followed_id=target,
+                                 user_following_id=source))
+        else:
+            writer.writerow(dict(user_id=source, message_id=target))
+
+    if uniform:
+        print(f"Drew {uniform:,} of {count:,} {kind} in part {part} uniformly; "
+              f"lower --exponent or --{kind} to keep them all power-law")
+
+
+def write_follows(args, part, first, last, writer):
+    """Write the follows by users `first` to `last`."""
+
+    write_pairs(args, 'follows', part, first, last, writer)
+
+
+def write_likes(args, part, first, last, writer):
+    """Write the likes by users `first` to `last`."""
+
+    write_pairs(args, 'likes', part, first, last, writer)
+
+
+# kind -> (CSV headers, function writing one part)
+GENERATORS = {
+    'users': (USERS_CSV_HEADERS, write_users),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows),
+    'likes': (LIKES_CSV_HEADERS, write_likes),
+}
+
+
+def parts(rows, per_part, ids):
+    """Split ids 1 to `ids` into `(first, last)` ranges holding about
+    `per_part` of `rows` rows each."""
+
+    count = min(max(math.ceil(rows / per_part), 1), ids)
+
+    return [(ids * i // count + 1, ids * (i + 1) // count)
+            for i in range(count)]
+
+
+def write_part(task):
+    """Write one part of a CSV to its own file; returns the file's path."""
+
+    args, kind, part, first, last = task
+    headers, write = GENERATORS[kind]
+    path = os.path.join(args.out_dir, f"{kind}.csv.part{part:05}")
+
+    with open(path, 'w', newline='') as part_csv:
+        write(args, part, first, last,
+              csv.DictWriter(part_csv, fieldnames=headers))
+
+    return path
+
+
+def generate(args, kind, pool):
+    """Write `<kind>.csv` from parts generated by `pool`."""
+
+    rows = getattr(args, kind)
+
+    if kind in ('users', 'messages'):
+        ranges = parts(rows, ROWS_PER_PART, rows)
+    else:
+        # parted by who's following/liking
+        ranges = parts(rows, PAIRS_PER_PART, args.users)
+
+    tasks = [(args, kind, part, first, last)
+             for part, (first, last) in enumerate(ranges)]
+    headers, _ = GENERATORS[kind]
+
+    with open(os.path.join(args.out_dir, f"{kind}.csv"), 'w',
+              newline='') as out:
+        csv.DictWriter(out, fieldnames=headers).writeheader()
+
+        # imap keeps the parts in order, however they finish
+        for path in pool.imap(write_part, tasks):
+            with open(path) as part_csv:
+                shutil.copyfileobj(part_csv, out)
+            os.remove(path)
+
+    print(f"Wrote {rows:,} {kind}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=0)
+    parser.add_argument('--exponent', type=float, default=1.0,
+                        help="power-law exponent of popularity (default: 1; "
+                             "higher concentrates follows/likes on fewer "
+                             "users/messages)")
+    parser.add_argument('--seed', default='warbler',
+                        help="seed of the random data (default: warbler)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--out-dir', default=os.path.dirname(__file__),
+                        help="directory to write the CSVs to "
+                             "(default: this script's)")
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error("--users must be at least 2")
+
+    # Random sampling gets slow as the graph fills up
+    if args.follows > args.users * (args.users - 1) // 2:
+        parser.error("--follows must be at most half of all user pairs")
+
+    if args.likes and args.likes > args.users * args.messages // 2:
+        parser.error("--likes must be at most half of all "
+                     "user/message pairs")
+
+    # Timestamps are spread over the two years before today
+    args.now = datetime.combine(datetime.today(), datetime.min.time())
+
+    kinds = ['users', 'messages', 'follows']
+
+    if args.likes:
+        kinds.append('likes')
+    elif os.path.exists(os.path.join(args.out_dir, 'likes.csv')):
+        # would refer to messages that may not exist anymore
+        os.remove(os.path.join(args.out_dir, 'likes.csv'))
+
+    with Pool(args.processes) as pool:
+        for kind in kinds:
+            generate(args, kind, pool)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
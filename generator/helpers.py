@@ -1,14 +1,109 @@
 """Support functions for CSV generation."""
 
+import math
+import random
 from datetime import datetime
-from random import uniform
 
+# Header images, as listed by the splashbase API (kept here so generating
+# data doesn't need the network)
+HEADER_IMAGE_URLS = [
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/{name}"
+    for name in [
+        'tumblr_mnh0n9pHJW1st5lhmo1_1280.jpg',
+        'tumblr_mnh0uemhCk1st5lhmo1_1280.jpg',
+        'tumblr_mnh121HEWa1st5lhmo1_1280.jpg',
+        'tumblr_mnh17lfd9R1st5lhmo1_1280.jpg',
+        'tumblr_mnh1d7s3UD1st5lhmo1_1280.jpg',
+        'tumblr_mnh1jdFvHR1st5lhmo1_1280.jpg',
+        'tumblr_mnh1uhYnog1st5lhmo1_1280.jpg',
+        'tumblr_mnh25vNOvI1st5lhmo1_1280.jpg',
+        'tumblr_mnh29fxz111st5lhmo1_1280.jpg',
+        'tumblr_mnh2m1hnS81st5lhmo1_1280.jpg',
+        'tumblr_mo1h6tGOZf1st5lhmo1_1280.jpg',
+        'tumblr_mo2wz2LTCs1st5lhmo1_1280.jpg',
+        'tumblr_mo2x3aAnRH1st5lhmo1_1280.jpg',
+        'tumblr_mo2x80NkDu1st5lhmo1_1280.jpg',
+        'tumblr_mo2x9xqeef1st5lhmo1_1280.jpg',
+        'tumblr_mo2xbk8JUK1st5lhmo1_1280.jpg',
+        'tumblr_mo2xdqmle51st5lhmo1_1280.jpg',
+        'tumblr_mo2xfarCvW1st5lhmo1_1280.jpg',
+        'tumblr_mo2xgqdEFn1st5lhmo1_1280.jpg',
+        'tumblr_mo2xijE2nr1st5lhmo1_1280.jpg',
+        'tumblr_mopq4kHmAg1st5lhmo1_1280.jpg',
+        'tumblr_mopq69jlcS1st5lhmo1_1280.jpg',
+        'tumblr_mopq8fyQwI1st5lhmo1_1280.jpg',
+        'tumblr_mopqamedKu1st5lhmo1_1280.jpg',
+        'tumblr_mopqc3ZZcz1st5lhmo1_1280.jpg',
+        'tumblr_mopqdfx05t1st5lhmo1_1280.jpg',
+        'tumblr_mopqfpSTPN1st5lhmo1_1280.jpg',
+        'tumblr_mopqhxFulr1st5lhmo1_1280.jpg',
+        'tumblr_mopqj9QUeq1st5lhmo1_1280.jpg',
+        'tumblr_mopqkkwK2M1st5lhmo1_1280.jpg',
+        'tumblr_mp6rzyNlAN1st5lhmo1_1280.jpg',
+        'tumblr_mp6s1hAudo1st5lhmo1_1280.jpg',
+        'tumblr_mp6s32zb6l1st5lhmo1_1280.jpg',
+        'tumblr_mp6s4dzqHA1st5lhmo1_1280.jpg',
+        'tumblr_mp6s661UgK1st5lhmo1_1280.jpg',
+        'tumblr_mp6s7lR1lS1st5lhmo1_1280.jpg',
+        'tumblr_mp6s995bvI1st5lhmo1_1280.jpg',
+        'tumblr_mp6sasSvPZ1st5lhmo1_1280.jpg',
+        'tumblr_mp6scv2xrZ1st5lhmo1_1280.jpg',
+        'tumblr_mpp6f50W261st5lhmo1_1280.jpg',
+        'tumblr_mpp6gwrYvm1st5lhmo1_1280.jpg',
+        'tumblr_mpp6l06zXi1st5lhmo1_1280.jpg',
+        'tumblr_mpp6poZxE51st5lhmo1_1280.jpg',
+        'tumblr_mpp6tjdFhf1st5lhmo1_1280.jpg',
+        'tumblr_mpp6w0dxAm1st5lhmo1_1280.jpg',
+    ]
+]
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the `year_gap` years before `now`
+    (default: the current time), using the random generator `rng`."""
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+class PowerLawSampler:
+    """Draws ids 1 to `n` with the probability of the k-th most popular id
+    proportional to k ** -exponent (a Zipf distribution).
+
+    Takes constant memory whatever `n` is: the rank is drawn from the
+    continuous power law's inverse CDF, then scattered over the ids by a
+    fixed permutation, so popular ids aren't all small ones.
+    """
+
+    # Knuth's multiplicative hashing constant (a prime)
+    SCATTER = 2654435761
+
+    def __init__(self, n, exponent=1.0):
+        self.n = n
+        self.exponent = exponent
+
+        # a multiplier coprime with n permutes 0..n-1
+        self.multiplier = self.SCATTER % n or 1
+        while math.gcd(self.multiplier, n) != 1:
+            self.multiplier += 1
+
+    def rank(self, rng):
+        """Draw a popularity rank from 1 (most popular) to n."""
+
+        u = rng.random()
+
+        if self.exponent == 1:
+            rank = (self.n + 1) ** u
+        else:
+            a = 1 - self.exponent
+            rank = ((((self.n + 1) ** a) - 1) * u + 1) ** (1 / a)
+
+        return min(int(rank), self.n)
+
+    def sample(self, rng):
+        """Draw an id."""
+
+        return (self.rank(rng) - 1) * self.multiplier % self.n + 1
@@ -0,0 +1,87 @@
+"""Password hashing for Warbler."""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_WORKERS = max((os.cpu_count() or 2) // 2, 1)
+
+
+class PasswordHasher:
+    """bcrypt hashing with a configurable cost, run in a bounded thread pool.
+
+    bcrypt releases the GIL while it hashes, so handing the work to a pool
+    keeps the hashing itself off the request thread. It also caps the number
+    of hashes computed at once per process, so a burst of logins can only
+    occupy that many cores and the other routes keep getting served.
+
+    Settings, from the app config:
+
+    - BCRYPT_LOG_ROUNDS: cost factor for new hashes (default 12). Read on
+      every call, so it can be changed at runtime (and in tests).
+    - PASSWORD_HASH_WORKERS: hashes computed at once (default: half the
+      CPUs). Read once, by init_app.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._bcrypt = Bcrypt()
+        self._executor = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config['PASSWORD_HASH_WORKERS'],
+            thread_name_prefix='password-hash')
+
+    @property
+    def log_rounds(self):
+        """Cost factor new hashes are generated with."""
+
+        if self.app is None:
+            return DEFAULT_LOG_ROUNDS
+
+        return self.app.config['BCRYPT_LOG_ROUNDS']
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` in the hashing pool and wait for its result."""
+
+        if self._executor is None:
+            return fn(*args)
+
+        return self._executor.submit(fn, *args).result()
+
+    def generate(self, password):
+        """Hash `password` at the configured cost.
+
+        Raises ValueError if the password is empty.
+        """
+
+        pw_hash = self._run(self._bcrypt.generate_password_hash,
+                            password, self.log_rounds)
+
+        return pw_hash.decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run(self._bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made at a different cost than the configured one?
+
+        bcrypt hashes look like `$2b$<cost>$<salt and hash>`.
+        """
+
+        try:
+            return int(pw_hash.split('$')[2]) != self.log_rounds
+        except (IndexError, ValueError):
+            return True
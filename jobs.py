@@ -0,0 +1,293 @@
+"""Background jobs for Warbler.
+
+Work a request causes but doesn't need to wait for (copying a new message
+into followers' timelines, say) is queued as a row of the jobs table, in
+the same transaction as the write that caused it, so it's queued if and
+only if the write commits:
+
+    post = Message(...)
+    db.session.add(post)
+    db.session.flush()
+    enqueue('fan_out', post.id)
+    db.session.commit()
+
+An idempotency key keeps a job from being queued again while a job with
+the same key is kept (until `flask jobs clean` deletes it), for work that
+might be requested more than once. Keys must stay unique for that long;
+ids SQLite may hand out again don't make good keys.
+
+Workers started with `flask jobs work` run the queued jobs. A job that
+raises is retried later, waiting twice as long after each attempt, until
+it's used up its attempts and is marked failed. A worker that dies while
+running a job holds it only until its lease runs out; then another worker
+runs it again. So jobs may run more than once and must be safe to repeat.
+
+With JOBS_SYNC on (in the tests, and for development without a worker),
+enqueue() runs the job at once instead, in the caller's transaction.
+"""
+
+import time
+import traceback
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects import postgresql
+
+from models import db, Follows, Job, TimelineEntry
+
+# name -> function, of the jobs that can be queued (see @job)
+registry = {}
+
+# Longest wait between a failed attempt and the next
+MAX_RETRY_DELAY = 3600
+
+# Longest error kept for a failed attempt
+MAX_ERROR_LENGTH = 2000
+
+
+def job(fn):
+    """Register `fn` as a job, queued under its name:
+
+        @job
+        def fan_out(message_id): ...
+
+    Its arguments must be JSON-serializable. It runs in a transaction
+    that's committed when it returns and rolled back if it raises.
+    """
+
+    registry[fn.__name__] = fn
+    return fn
+
+
+def enqueue(name, *args, key=None):
+    """Queue job `name` to run with `args`, unless a job with the
+    idempotency `key` is queued, running or kept as done.
+
+    The job is added to the current transaction; commit it for the job to
+    be run. With JOBS_SYNC on, the job is run at once, also in the current
+    transaction, whatever its key.
+    """
+
+    if current_app.config['JOBS_SYNC']:
+        registry[name](*args)
+        return
+
+    values = dict(name=name, args=list(args), key=key,
+                  max_attempts=current_app.config['JOBS_MAX_ATTEMPTS'])
+    dialect = db.engine.dialect.name
+
+    if key is None:
+        stmt = Job.__table__.insert().values(**values)
+    elif dialect == 'postgresql':
+        stmt = (postgresql.insert(Job.__table__)
+                .values(**values)
+                .on_conflict_do_nothing(index_elements=['key']))
+    elif dialect == 'sqlite':
+        stmt = Job.__table__.insert().prefix_with('OR IGNORE').values(**values)
+    elif Job.query.filter_by(key=key).first() is None:
+        stmt = Job.__table__.insert().values(**values)
+    else:
+        return
+
+    db.session.execute(stmt)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before retrying a job that's failed `attempts` times."""
+
+    delay = current_app.config['JOBS_RETRY_DELAY'] * 2 ** (attempts - 1)
+
+    return min(delay, MAX_RETRY_DELAY)
+
+
+def claim(now=None):
+    """Lease the next due job to this worker.
+
+    Returns the job, or None if no job is due. Workers racing for the same
+    job each try to bump its attempts from the number they saw; only one
+    update matches.
+    """
+
+    now = now or datetime.utcnow()
+    due = (Job.status.in_(['queued', 'running']), Job.run_at <= now)
+
+    # a worker died running these on their last attempt
+    (Job.query
+     .filter(*due, Job.status == 'running',
+             Job.attempts >= Job.max_attempts)
+     .update({'status': 'failed', 'last_error': "Lease expired"},
+             synchronize_session=False))
+    db.session.commit()
+
+    while True:
+        candidate = (db.session
+                     .query(Job.id, Job.attempts)
+                     .filter(*due, Job.attempts < Job.max_attempts)
+                     .order_by(Job.run_at, Job.id)
+                     .first())
+
+        if candidate is None:
+            return None
+
+        lease = timedelta(seconds=current_app.config['JOBS_LEASE'])
+        claimed = (Job.query
+                   .filter(*due, Job.id == candidate.id,
+                           Job.attempts == candidate.attempts)
+                   .update({'status': 'running',
+                            'attempts': candidate.attempts + 1,
+                            'run_at': now + lease},
+                           synchronize_session=False))
+        db.session.commit()
+
+        if claimed:
+            return Job.query.get(candidate.id)
+
+
+def run(job_row):
+    """Run a claimed job, then record how it went."""
+
+    job_id = job_row.id
+
+    try:
+        registry[job_row.name](*job_row.args)
+        job_row.status = 'done'
+        job_row.last_error = None
+        db.session.commit()
+        return True
+
+    except Exception:
+        db.session.rollback()
+
+        job_row = Job.query.get(job_id)
+        job_row.last_error = traceback.format_exc()[-MAX_ERROR_LENGTH:]
+
+        if job_row.attempts >= job_row.max_attempts:
+            job_row.status = 'failed'
+        else:
+            job_row.status = 'queued'
+            job_row.run_at = (datetime.utcnow() +
+                              timedelta(seconds=retry_delay(job_row.attempts)))
+
+        db.session.commit()
+        return False
+
+
+def work(once=False, poll=1.0):
+    """Run due jobs one after another; with `once`, until none are due,
+    otherwise forever, checking for new ones every `poll` seconds.
+
+    Returns the number of jobs run.
+    """
+
+    count = 0
+
+    while True:
+        job_row = claim()
+
+        if job_row is not None:
+            run(job_row)
+            count += 1
+        elif once:
+            return count
+        else:
+            time.sleep(poll)
+
+
+def work_in_process(once, poll):
+    """work() in a pool process, with its own database connections."""
+
+    from app import app  # app.py imports this module
+
+    with app.app_context():
+        # connections inherited from the parent can't be shared
+        db.engine.dispose()
+        return work(once, poll)
+
+
+def status_counts():
+    """Number of jobs by status."""
+
+    return dict(db.session
+                .query(Job.status, db.func.count())
+                .group_by(Job.status))
+
+
+##############################################################################
+# Jobs
+
+
+@job
+def fan_out(message_id):
+    """Copy a new message into its author's followers' timelines."""
+
+    TimelineEntry.fan_out(message_id)
+
+
+@job
+def backfill_timeline(user_id, followed_id):
+    """Copy a newly followed user's messages into the follower's timeline,
+    if they still follow them."""
+
+    if Follows.exists(user_id, followed_id):
+        TimelineEntry.backfill(user_id, followed_id)
+
+
+@job
+def prune_timeline(user_id, followed_id):
+    """Take an unfollowed user's messages off the follower's timeline,
+    unless they've followed them again."""
+
+    if not Follows.exists(user_id, followed_id):
+        TimelineEntry.prune(user_id, followed_id)
+
+
+##############################################################################
+# CLI
+
+jobs_command = AppGroup('jobs', help="Run and manage background jobs.")
+
+
+@jobs_command.command('work')
+@click.option('--processes', default=1,
+              help="Worker processes to run (default: 1).")
+@click.option('--once', is_flag=True,
+              help="Exit once no jobs are due, instead of waiting for more.")
+@click.option('--poll', default=1.0,
+              help="Seconds between checks for new jobs (default: 1).")
+def work_command(processes, once, poll):
+    """Run queued jobs."""
+
+    if processes == 1:
+        count = work(once, poll)
+    else:
+        with Pool(processes) as pool:
+            count = sum(pool.starmap(work_in_process,
+                                     [(once, poll)] * processes))
+
+    click.echo(f"Ran {count} jobs")
+
+
+@jobs_command.command('clean')
+@click.option('--days', default=7,
+              help="Delete finished jobs older than this (default: 7).")
+def clean_command(days):
+    """Delete old done and failed jobs (and with them their keys)."""
+
+    count = (Job.query
+             .filter(Job.status.in_(['done', 'failed']),
+                     Job.created_at < datetime.utcnow() - timedelta(days=days))
+             .delete(synchronize_session=False))
+    db.session.commit()
+
+    click.echo(f"Deleted {count} jobs")
+
+
+@jobs_command.command('status')
+def status_command():
+    """Show how many jobs there are of each status."""
+
+    for status, count in sorted(status_counts().items()):
+        click.echo(f"{status}: {count}")
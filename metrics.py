@@ -0,0 +1,323 @@
+"""Runtime metrics for Warbler, reported per worker process.
+
+    GET /internal/metrics
+    Authorization: Bearer <METRICS_TOKEN>
+
+responds with JSON holding the database connection pool's state (how many
+connections are checked out, in overflow, and how long checkouts wait),
+each endpoint's latency histogram and SQL use (see RequestMetrics), and
+whatever else the app registers with `metrics.register()`. Numbers count
+from the process's start, so compare two readings to get rates. Requests
+without the METRICS_TOKEN setting's token get a 404, as does every request
+while it's empty (the default).
+"""
+
+import hmac
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+from sqlalchemy.pool import QueuePool
+
+internal = Blueprint('internal', __name__, url_prefix='/internal')
+
+# name -> function returning a JSON-ready value, collected per reading
+sources = {}
+
+
+def register(name, source):
+    """Report `source()` as `name` in every metrics reading."""
+
+    sources[name] = source
+
+
+class PoolStats:
+    """Counts of connection checkouts, across every pool of the process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.checkouts = 0
+            self.waits = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def record(self, seconds, waited, timed_out=False):
+        """Count a checkout that took `seconds`, and whether it had to wait
+        for a connection to be returned (and gave up)."""
+
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            self.waits += waited
+            self.timeouts += timed_out
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'avg_checkout_ms': round(
+                    1000 * self.wait_seconds / max(self.checkouts, 1), 3),
+                'max_checkout_ms': round(1000 * self.max_wait_seconds, 3),
+            }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times each checkout into `pool_stats`.
+
+    A checkout waits when every pooled connection is in use and the
+    overflow is used up; one that waits longer than `pool_timeout` raises
+    TimeoutError, and counts as a timeout.
+    """
+
+    def _do_get(self):
+        waited = (self._pool.empty() and
+                  -1 < self._max_overflow <= self._overflow)
+        start = time.perf_counter()
+
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record(time.perf_counter() - start, True, True)
+            raise
+
+        pool_stats.record(time.perf_counter() - start, waited)
+        return conn
+
+
+def pool_metrics(pool):
+    """State of the connection pool `pool`, plus the checkout counts."""
+
+    metrics = {'class': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        metrics.update(size=pool.size(),
+                       checked_in=pool.checkedin(),
+                       checked_out=pool.checkedout(),
+                       overflow=max(pool.overflow(), 0),
+                       max_overflow=pool._max_overflow,
+                       timeout=pool.timeout())
+
+    metrics.update(pool_stats.as_dict())
+    return metrics
+
+
+# Upper bounds, in milliseconds, of the request latency histogram's buckets
+# (plus one for anything slower)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Stats of the request being handled. A context variable, so the threads
+# of parallel.ParallelFetcher (which run in a copy of the request's context)
+# add their queries to it too.
+current_request = ContextVar('current_request', default=None)
+
+
+class RequestStats:
+    """Time, SQL statements and rows loaded of one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def add_query(self, seconds):
+        with self._lock:
+            self.queries += 1
+            self.sql_seconds += seconds
+
+    def add_row(self):
+        with self._lock:
+            self.rows += 1
+
+
+class EndpointStats:
+    """Totals and latency histogram of the requests to one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, seconds, stats):
+        self.requests += 1
+        self.seconds += seconds
+        self.queries += stats.queries
+        self.sql_seconds += stats.sql_seconds
+        self.rows += stats.rows
+
+        ms = seconds * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS)
+                       if ms <= bound), len(LATENCY_BUCKETS_MS))
+        self.buckets[bucket] += 1
+
+    def percentile_ms(self, fraction):
+        """Upper bound of the bucket holding the `fraction` percentile
+        (None if it's the unbounded one)."""
+
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS + (None,), self.buckets):
+            seen += count
+            if seen >= fraction * self.requests:
+                return bound
+
+        return None
+
+    def as_dict(self):
+        requests = max(self.requests, 1)
+
+        return {
+            'requests': self.requests,
+            'avg_ms': round(1000 * self.seconds / requests, 3),
+            'p50_ms': self.percentile_ms(0.5),
+            'p95_ms': self.percentile_ms(0.95),
+            'p99_ms': self.percentile_ms(0.99),
+            # [upper bound, requests] per bucket; the last bound is None
+            'histogram_ms': [list(bucket) for bucket in
+                             zip(LATENCY_BUCKETS_MS + (None,), self.buckets)],
+            'avg_queries': round(self.queries / requests, 2),
+            'avg_sql_ms': round(1000 * self.sql_seconds / requests, 3),
+            'avg_rows': round(self.rows / requests, 2),
+        }
+
+
+class RequestMetrics:
+    """Times every request, and counts its SQL statements, the time spent
+    in them and the ORM rows they loaded, totalled per endpoint.
+
+    Settings, from the app config:
+
+    - SERVER_TIMING: also report each request's numbers to the client in a
+      `Server-Timing` header (default off), which browsers' developer tools
+      show with the request.
+    """
+
+    def __init__(self, app=None):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SERVER_TIMING', False)
+
+        # first in and last out, so the other hooks are timed too
+        app.before_request_funcs.setdefault(None, []).insert(
+            0, self.start_request)
+        app.after_request_funcs.setdefault(None, []).insert(
+            0, self.finish_request)
+        app.teardown_request(self.end_request)
+
+        if not event.contains(Engine, 'before_cursor_execute', before_execute):
+            event.listen(Engine, 'before_cursor_execute', before_execute)
+            event.listen(Engine, 'after_cursor_execute', after_execute)
+            event.listen(Mapper, 'load', count_row)
+
+        register('requests', self.as_dict)
+
+    def start_request(self):
+        """Start the stats of a request."""
+
+        current_request.set(RequestStats())
+
+    def finish_request(self, response):
+        """Add the request's stats to its endpoint's."""
+
+        stats = current_request.get()
+
+        if stats is None:
+            return response
+
+        seconds = time.perf_counter() - stats.start
+
+        with self._lock:
+            endpoint = self.endpoints.setdefault(request.endpoint or '<none>',
+                                                 EndpointStats())
+            endpoint.record(seconds, stats)
+
+        if current_app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                f"app;dur={1000 * seconds:.1f}, "
+                f"sql;dur={1000 * stats.sql_seconds:.1f};"
+                f"desc=\"{stats.queries} queries, {stats.rows} rows\"")
+
+        return response
+
+    def end_request(self, exc=None):
+        """Stop counting queries towards the finished request."""
+
+        current_request.set(None)
+
+    def as_dict(self):
+        with self._lock:
+            return {endpoint: stats.as_dict()
+                    for endpoint, stats in sorted(self.endpoints.items())}
+
+    def clear(self):
+        with self._lock:
+            self.endpoints.clear()
+
+
+def before_execute(conn, cursor, statement, parameters, context, executemany):
+    """Note when a statement starts."""
+
+    conn.info['query_start'] = time.perf_counter()
+
+
+def after_execute(conn, cursor, statement, parameters, context, executemany):
+    """Add a finished statement to the current request's stats."""
+
+    start = conn.info.pop('query_start', None)
+    stats = current_request.get()
+
+    if stats is not None and start is not None:
+        stats.add_query(time.perf_counter() - start)
+
+
+def count_row(target, context):
+    """Count an ORM object loaded from a row for the current request."""
+
+    stats = current_request.get()
+
+    if stats is not None:
+        stats.add_row()
+
+
+@internal.route('/metrics')
+def show_metrics():
+    """This worker's metrics, as JSON."""
+
+    token = current_app.config.get('METRICS_TOKEN', '')
+    # compared as bytes: compare_digest refuses non-ASCII strings, and
+    # header values are decoded as latin-1
+    given = request.headers.get('Authorization', '').encode('latin-1')
+
+    if not token or not hmac.compare_digest(given,
+                                            f"Bearer {token}".encode()):
+        abort(404)
+
+    db = current_app.extensions['sqlalchemy'].db
+
+    return jsonify(pid=os.getpid(),
+                   pool=pool_metrics(db.engine.pool),
+                   **{name: source() for name, source in sources.items()})
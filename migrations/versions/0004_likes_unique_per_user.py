@@ -0,0 +1,35 @@
+"""likes unique per user
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 04:19:11.036254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+# Names the constraints get from db.create_all() on Postgres; on SQLite,
+# where they're unnamed, batch mode finds them by this convention
+NAMING_CONVENTION = {'uq': '%(table_name)s_%(column_0_N_name)s_key'}
+
+
+def upgrade():
+    # one like per user and message, where the original schema allowed each
+    # message only one like in all
+    with op.batch_alter_table('likes', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint('likes_message_id_key', type_='unique')
+        batch_op.create_unique_constraint('likes_user_id_message_id_key', ['user_id', 'message_id'])
+
+
+def downgrade():
+    # fails if a message has been liked by more than one user
+    with op.batch_alter_table('likes', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint('likes_user_id_message_id_key', type_='unique')
+        batch_op.create_unique_constraint('likes_message_id_key', ['message_id'])
@@ -0,0 +1,61 @@
+"""user search
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 05:02:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+# Keep in step with search.USER_SEARCH_DOCUMENT
+USER_SEARCH_DOCUMENT = (
+    "to_tsvector('simple', coalesce(username, '') || ' ' || "
+    "coalesce(bio, '') || ' ' || coalesce(location, ''))")
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute(f"CREATE INDEX ix_users_search ON users USING gin "
+                   f"(({USER_SEARCH_DOCUMENT}))")
+
+    elif dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE users_fts USING fts5("
+                   "username, bio, location, content='users', "
+                   "content_rowid='id')")
+        op.execute("CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN "
+                   "INSERT INTO users_fts(rowid, username, bio, location) "
+                   "VALUES (new.id, new.username, new.bio, new.location); END")
+        op.execute("CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN "
+                   "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+                   "VALUES ('delete', old.id, old.username, old.bio, old.location); END")
+        op.execute("CREATE TRIGGER users_fts_update "
+                   "AFTER UPDATE OF username, bio, location ON users BEGIN "
+                   "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+                   "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+                   "INSERT INTO users_fts(rowid, username, bio, location) "
+                   "VALUES (new.id, new.username, new.bio, new.location); END")
+        # Index the users that already exist
+        op.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.drop_index('ix_users_search', table_name='users')
+
+    elif dialect == 'sqlite':
+        for trigger in ['users_fts_insert', 'users_fts_delete',
+                        'users_fts_update']:
+            op.execute(f"DROP TRIGGER {trigger}")
+        op.execute("DROP TABLE users_fts")
@@ -0,0 +1,61 @@
+"""message search
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 05:40:12.527790
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+# Keep in step with search.MESSAGE_SEARCH_DOCUMENT
+MESSAGE_SEARCH_DOCUMENT = "to_tsvector('english', text)"
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute(f"CREATE INDEX ix_messages_search ON messages USING gin "
+                   f"(({MESSAGE_SEARCH_DOCUMENT}))")
+
+    elif dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE messages_fts USING fts5("
+                   "text, content='messages', content_rowid='id', "
+                   "tokenize='porter unicode61')")
+        op.execute("CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages "
+                   "BEGIN "
+                   "INSERT INTO messages_fts(rowid, text) "
+                   "VALUES (new.id, new.text); END")
+        op.execute("CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages "
+                   "BEGIN "
+                   "INSERT INTO messages_fts(messages_fts, rowid, text) "
+                   "VALUES ('delete', old.id, old.text); END")
+        op.execute("CREATE TRIGGER messages_fts_update "
+                   "AFTER UPDATE OF text ON messages BEGIN "
+                   "INSERT INTO messages_fts(messages_fts, rowid, text) "
+                   "VALUES ('delete', old.id, old.text); "
+                   "INSERT INTO messages_fts(rowid, text) "
+                   "VALUES (new.id, new.text); END")
+        # Index the messages that already exist
+        op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.drop_index('ix_messages_search', table_name='messages')
+
+    elif dialect == 'sqlite':
+        for trigger in ['messages_fts_insert', 'messages_fts_delete',
+                        'messages_fts_update']:
+            op.execute(f"DROP TRIGGER {trigger}")
+        op.execute("DROP TABLE messages_fts")
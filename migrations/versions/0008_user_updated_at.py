@@ -0,0 +1,31 @@
+"""user updated at
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17 06:44:31.554460
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        # SQLite can't add a column defaulting to CURRENT_TIMESTAMP; any
+        # constant works as the existing rows' first version
+        server_default = '1970-01-01 00:00:00'
+    else:
+        server_default = sa.func.now()
+
+    op.add_column('users', sa.Column('updated_at', sa.DateTime(), server_default=server_default, nullable=False))
+
+
+def downgrade():
+    op.drop_column('users', 'updated_at')
@@ -2,11 +2,21 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
+from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, event, exists, func, inspect, literal, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import joinedload
 
-bcrypt = Bcrypt()
+from hashing import PasswordHasher
+from metrics import InstrumentedQueuePool
+from slowlog import SlowQueryLog
+
+hasher = PasswordHasher()
 db = SQLAlchemy()
+migrate = Migrate()
+slow_queries = SlowQueryLog()
 
 
 class Follows(db.Model):
@@ -26,6 +36,24 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key covers lookups by followed user; this covers the
+    # reverse direction (who a user follows).
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id'),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does user `follower_id` follow user `followed_id`?
+
+        A primary key lookup, so it doesn't load either user's follows.
+        """
+
+        return db.session.query(
+            cls.query.filter(cls.user_being_followed_id == followed_id,
+                             cls.user_following_id == follower_id).exists()
+        ).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbler."""
@@ -45,9 +73,66 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+        # a user's likes page, newest like first
+        db.Index('ix_likes_user_id_id', 'user_id', 'id'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like message `message_id` for user `user_id`, or unlike it if it's
+        already liked. Returns whether the message is now liked.
+
+        A single DELETE, or a single INSERT that ignores a concurrent duplicate,
+        so the cost doesn't depend on how many messages the user likes.
+        """
+
+        unliked = (cls.query
+                   .filter(cls.user_id == user_id, cls.message_id == message_id)
+                   .delete(synchronize_session=False))
+
+        if unliked:
+            User.adjust_counters(user_id, likes_count=-1)
+            return False
+
+        values = dict(user_id=user_id, message_id=message_id)
+        dialect = db.engine.dialect.name
+
+        if dialect == 'postgresql':
+            stmt = (postgresql.insert(cls.__table__)
+                    .values(**values)
+                    .on_conflict_do_nothing())
+        elif dialect == 'sqlite':
+            stmt = cls.__table__.insert().prefix_with('OR IGNORE').values(**values)
+        else:
+            stmt = cls.__table__.insert().values(**values)
+
+        if db.session.execute(stmt).rowcount:
+            User.adjust_counters(user_id, likes_count=1)
+
+        return True
+
+    @classmethod
+    def liked_among(cls, user_id, message_ids):
+        """Set of the ids in `message_ids` that user `user_id` has liked.
+
+        One index lookup for just the messages on the page, instead of
+        loading every message the user has ever liked.
+        """
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.message_id)
+                .filter(cls.user_id == user_id,
+                        cls.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +179,50 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized relationship counts, kept current by the listeners below
+    # so profile pages don't load whole collections just to count them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # When the profile columns shown on user and message cards last changed;
+    # versions the cached cards (see fragments.py). Counter updates don't
+    # touch it.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # Columns whose changes bump updated_at
+    CARD_COLUMNS = ('username', 'image_url', 'header_image_url', 'bio')
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,16 +250,29 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Set of the ids in `user_ids` that this user follows.
+
+        Answers "follow or unfollow?" for a whole page of users in one query,
+        rather than one is_following() call per user.
+        """
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -139,7 +281,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.generate(password)
 
         user = User(
             username=username,
@@ -151,6 +293,53 @@ class User(db.Model):
         db.session.add(user)
         return user
 
+    @classmethod
+    def adjust_counters(cls, user_id, connection=None, **deltas):
+        """Add `deltas` to the counter columns of user `user_id`.
+
+        Runs on `connection` (the session by default) so the change commits
+        or rolls back with the write that caused it:
+
+            User.adjust_counters(user.id, likes_count=1)
+        """
+
+        users = cls.__table__
+        (connection or db.session).execute(
+            users
+            .update()
+            .where(users.c.id == user_id)
+            .values({users.c[name]: users.c[name] + delta
+                     for name, delta in deltas.items()}))
+
+    @classmethod
+    def refresh_counters(cls, user_ids=None):
+        """Recount the counter columns from the underlying tables.
+
+        Needed after writes that bypass the ORM (bulk loads, database
+        cascades). Refreshes every user if `user_ids` is None.
+        """
+
+        users = cls.__table__
+
+        def count(column, owner_column):
+            return (select([func.count(column)])
+                    .where(owner_column == users.c.id)
+                    .as_scalar())
+
+        stmt = users.update().values(
+            messages_count=count(Message.id, Message.user_id),
+            following_count=count(Follows.user_being_followed_id,
+                                  Follows.user_following_id),
+            followers_count=count(Follows.user_following_id,
+                                  Follows.user_being_followed_id),
+            likes_count=count(Likes.message_id, Likes.user_id),
+        )
+
+        if user_ids is not None:
+            stmt = stmt.where(users.c.id.in_(user_ids))
+
+        db.session.execute(stmt)
+
     @classmethod
     def authenticate(cls, username, password):
         """Find user with `username` and `password`.
@@ -160,13 +349,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the password was hashed at a different cost than the one now
+        configured, it's rehashed; commit the session to save the new hash.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.generate(password)
                 return user
 
         return False
@@ -190,7 +384,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -201,6 +395,337 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # Author columns shown on every message card, and its cache version
+    AUTHOR_COLUMNS = ('id', 'username', 'image_url', 'updated_at')
+
+    @classmethod
+    def with_authors(cls):
+        """Query for messages that fetches each author in the same query.
+
+        Feeds render `msg.user` for every message; with the default lazy
+        relationship that's one extra SELECT per message.
+        """
+
+        return cls.query.options(
+            joinedload(cls.user, innerjoin=True).load_only(*cls.AUTHOR_COLUMNS))
+
+
+# Profiles page through a user's messages newest-first.
+db.Index('ix_messages_user_id_timestamp',
+         Message.user_id,
+         Message.timestamp.desc(),
+         Message.id.desc())
+
+
+# Keep User's counter columns in step with the rows they count. These fire
+# for ORM inserts/deletes of Message, Follows and Likes (not for appends to
+# the `following`/`likes` collections, which write the tables directly).
+
+@event.listens_for(Message, 'after_insert')
+def count_new_message(mapper, connection, message):
+    User.adjust_counters(message.user_id, connection, messages_count=1)
+
+
+@event.listens_for(Message, 'after_delete')
+def count_deleted_message(mapper, connection, message):
+    User.adjust_counters(message.user_id, connection, messages_count=-1)
+
+
+@event.listens_for(Follows, 'after_insert')
+def count_new_follow(mapper, connection, follow):
+    User.adjust_counters(follow.user_following_id, connection,
+                         following_count=1)
+    User.adjust_counters(follow.user_being_followed_id, connection,
+                         followers_count=1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def count_deleted_follow(mapper, connection, follow):
+    User.adjust_counters(follow.user_following_id, connection,
+                         following_count=-1)
+    User.adjust_counters(follow.user_being_followed_id, connection,
+                         followers_count=-1)
+
+
+@event.listens_for(Likes, 'after_insert')
+def count_new_like(mapper, connection, like):
+    User.adjust_counters(like.user_id, connection, likes_count=1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def count_deleted_like(mapper, connection, like):
+    User.adjust_counters(like.user_id, connection, likes_count=-1)
+
+
+@event.listens_for(User, 'before_update')
+def touch_user(mapper, connection, user):
+    """Bump `updated_at` when a column shown on the user's cards changes."""
+
+    state = inspect(user)
+
+    if any(state.attrs[column].history.has_changes()
+           for column in User.CARD_COLUMNS):
+        user.updated_at = datetime.utcnow()
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Entries are written when a message is posted (fan-out on write), so the
+    home page reads one user's timeline with a single index range scan
+    instead of searching the messages of everyone they follow.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def messages_for(cls, user_id):
+        """Query for the messages in `user_id`'s home timeline.
+
+        Order it by `TimelineEntry.timestamp` and `TimelineEntry.message_id`
+        so the timeline index is used (see pagination.paginate).
+        """
+
+        return (Message
+                .with_authors()
+                .join(cls, cls.message_id == Message.id)
+                .filter(cls.user_id == user_id))
+
+    @classmethod
+    def add_own(cls, message):
+        """Add a newly posted (flushed) message to its author's timeline."""
+
+        db.session.execute(cls.__table__.insert().values(
+            user_id=message.user_id,
+            message_id=message.id,
+            author_id=message.user_id,
+            timestamp=message.timestamp,
+        ))
+
+    @classmethod
+    def _missing(cls, user_id, message_id):
+        """Condition true when the timeline of `user_id` doesn't have
+        `message_id` yet, so that adding entries is safe to repeat."""
+
+        return ~exists().where(and_(cls.user_id == user_id,
+                                    cls.message_id == message_id))
+
+    @classmethod
+    def fan_out(cls, message_id):
+        """Add a posted message to the timeline of every user following
+        its author (skipping any that have it already, and doing nothing
+        if it's been deleted)."""
+
+        followers = select([
+            Follows.user_following_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        ]).where(and_(
+            Message.id == message_id,
+            Follows.user_being_followed_id == Message.user_id,
+            cls._missing(Follows.user_following_id, Message.id)))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], followers))
+
+    @classmethod
+    def backfill(cls, user_id, followed_id):
+        """Copy `followed_id`'s messages into `user_id`'s timeline (the ones
+        it doesn't have already)."""
+
+        messages = select([
+            literal(user_id, db.Integer),
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        ]).where(and_(Message.user_id == followed_id,
+                      cls._missing(user_id, Message.id)))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], messages))
+
+    @classmethod
+    def prune(cls, user_id, followed_id):
+        """Remove `followed_id`'s messages from `user_id`'s timeline."""
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.author_id == followed_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Remove a message from every timeline it was fanned out to."""
+
+        (cls.query
+         .filter(cls.message_id == message_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Recreate every timeline from the follows and messages tables.
+
+        Used after bulk loads (see seed.py), which bypass the fan-out.
+        """
+
+        own = select([
+            Message.user_id.label('user_id'),
+            Message.id,
+            Message.user_id.label('author_id'),
+            Message.timestamp,
+        ])
+        followed = select([
+            Follows.user_following_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        ]).where(Follows.user_being_followed_id == Message.user_id)
+
+        # union, not union_all: a user following themselves would get
+        # their own messages twice
+        cls.query.delete(synchronize_session=False)
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            own.union(followed)))
+
+
+# Home timelines are read newest-first per user; deletes look up by message.
+db.Index('ix_timeline_entries_user_id_timestamp',
+         TimelineEntry.user_id,
+         TimelineEntry.timestamp.desc(),
+         TimelineEntry.message_id.desc())
+db.Index('ix_timeline_entries_message_id', TimelineEntry.message_id)
+
+
+class Job(db.Model):
+    """Work queued to be done outside of a request (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # name the job's function is registered under
+    name = db.Column(
+        db.String(100),
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    # idempotency key: a job isn't queued again while one with its key is
+    # kept around
+    key = db.Column(
+        db.String(200),
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+        server_default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+        server_default='5',
+    )
+
+    # when a queued job is due, or a running one's lease runs out
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name}{tuple(self.args)} {self.status}>"
+
+
+# Workers look for the next due job
+db.Index('ix_jobs_status_run_at', Job.status, Job.run_at)
+
+
+def pool_options(app):
+    """Engine options for the connection pool, from the app's DB_POOL_*
+    and DB_STATEMENT_TIMEOUT settings.
+
+    SQLite gets Flask-SQLAlchemy's defaults (no pool for a file, one shared
+    connection in memory), so the settings only apply to server databases.
+    """
+
+    config = app.config
+    # the dialect's name, as Heroku-style postgres:// URLs name the backend
+    # 'postgres'
+    dialect = make_url(config['SQLALCHEMY_DATABASE_URI']).get_dialect().name
+
+    if dialect == 'sqlite':
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', -1),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', False),
+    }
+
+    timeout = config.get('DB_STATEMENT_TIMEOUT', 0)
+    if timeout and dialect == 'postgresql':
+        options['connect_args'] = {'options': f"-c statement_timeout={timeout}"}
+
+    return options
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,5 +733,10 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', pool_options(app))
+
     db.app = app
     db.init_app(app)
+    migrate.init_app(app, db)
+    hasher.init_app(app)
+    slow_queries.init_app(app)
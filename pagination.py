@@ -0,0 +1,101 @@
+"""Keyset (cursor) pagination for newest-first message lists.
+
+Pages are keyed on `(timestamp, id)` of the last message shown, so fetching
+page 50 costs the same index range scan as fetching page 1 (unlike OFFSET,
+which has to walk past every skipped row).
+
+Lists in the order their rows were added, such as a user's likes (newest
+like first), are keyed on that row's id alone instead (see paginate_by_id),
+so the index on the table being filtered serves the order as well.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import literal, tuple_
+
+from models import db
+
+CURSOR_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(message):
+    """Build the `?before=` cursor pointing just past `message`."""
+
+    return f"{message.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}-{message.id}"
+
+
+def decode_cursor(cursor):
+    """Split a cursor into `(timestamp, id)`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    timestamp, _, message_id = cursor.partition('-')
+
+    return (datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT),
+            int(message_id))
+
+
+def page_query(query, timestamp_col, id_col, before=None, per_page=20):
+    """Narrow `query` to the page after `before`, newest first.
+
+    Selects one row more than `per_page`, which tells whether there's
+    another page. Raises ValueError if `before` is malformed.
+    """
+
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        query = query.filter(
+            tuple_(timestamp_col, id_col) <
+            tuple_(literal(timestamp, db.DateTime),
+                   literal(message_id, db.Integer)))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1))
+
+
+def paginate(query, timestamp_col, id_col, before=None, per_page=20):
+    """Fetch one page of `query`, newest first.
+
+    `timestamp_col` and `id_col` are the columns the page is ordered on;
+    they must hold the same values as the `timestamp` and `id` of the
+    messages `query` returns.
+
+    Returns `(items, next_cursor)`; `next_cursor` is None on the last page.
+    Raises ValueError if `before` is malformed.
+    """
+
+    items = page_query(query, timestamp_col, id_col, before, per_page).all()
+
+    if len(items) > per_page:
+        items = items[:per_page]
+        return items, encode_cursor(items[-1])
+
+    return items, None
+
+
+def paginate_by_id(query, id_col, before=None, per_page=20):
+    """Fetch one page of `query`, highest `id_col` first.
+
+    The cursor is the `id_col` value of the last row shown; each row comes
+    with its value as `page_id`.
+
+    Returns `(rows, next_cursor)`; `next_cursor` is None on the last page.
+    Raises ValueError if `before` is malformed.
+    """
+
+    if before:
+        query = query.filter(id_col < int(before))
+
+    rows = (query
+            .add_columns(id_col.label('page_id'))
+            .order_by(id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        return rows, str(rows[-1].page_id)
+
+    return rows, None
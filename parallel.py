@@ -0,0 +1,80 @@
+"""Running a page's independent queries at the same time.
+
+A home page needs the timeline page, which of its messages the viewer
+likes, and the viewer's counters. None of these needs another's results,
+so instead of running them one after another they can each go to their own
+thread, with its own app context, session and pooled connection, and the
+page waits only as long as the slowest one.
+
+Workers' sessions are closed when they finish, so ORM objects they return
+are detached: merge them into the request's session (with `load=False`,
+which doesn't query) before using them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
+
+DEFAULT_WORKERS = 8
+
+
+class ParallelFetcher:
+    """Runs independent queries in a thread pool, or in turn when off.
+
+    Settings, from the app config:
+
+    - FEED_PARALLEL_FETCH: run queries concurrently (default off). Read on
+      every call, so it can be changed at runtime (and in tests). Leave it
+      off unless the connection pool has room for a few connections per
+      request.
+    - FEED_FETCH_WORKERS: queries run at once, across all requests
+      (default 8). Read once, by init_app.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('FEED_PARALLEL_FETCH', False)
+        app.config.setdefault('FEED_FETCH_WORKERS', DEFAULT_WORKERS)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config['FEED_FETCH_WORKERS'],
+            thread_name_prefix='feed-fetch')
+
+    @property
+    def enabled(self):
+        """Are queries run concurrently?"""
+
+        return (self._executor is not None and
+                self.app.config['FEED_PARALLEL_FETCH'])
+
+    def _call(self, fn, args):
+        """Run `fn(*args)` in its own app context, and so its own session,
+        which is closed as the context ends."""
+
+        with self.app.app_context():
+            return fn(*args)
+
+    def fetch(self, *calls):
+        """Run each `(fn, *args)` in `calls`; returns their results in order.
+
+        The first exception raised by a call is raised here, once every
+        call has finished.
+        """
+
+        if not self.enabled:
+            return [fn(*args) for fn, *args in calls]
+
+        # in copies of the request's context, so per-request stats kept in
+        # context variables (see metrics.py) include these queries
+        futures = [self._executor.submit(copy_context().run,
+                                         self._call, fn, args)
+                   for fn, *args in calls]
+        wait(futures)
+
+        return [future.result() for future in futures]
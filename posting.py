@@ -0,0 +1,57 @@
+"""Posting and deleting messages, shared by the site's views and the API.
+
+Cached pages are invalidated through the response cache app.py keeps in
+`app.extensions['responses']`.
+"""
+
+from flask import current_app
+
+from jobs import enqueue
+from models import db, User, Message, Likes, TimelineEntry
+
+
+def post_message(user_id, text):
+    """Post a message by `user_id` to their timeline, and queue fanning it
+    out to their followers'.
+
+    Commits, and invalidates the cached pages the message shows up on.
+    """
+
+    msg = Message(text=text, user_id=user_id)
+    db.session.add(msg)
+    db.session.flush()
+    TimelineEntry.add_own(msg)
+    # queued with the message, so it can't be queued twice; no key needed
+    # (and SQLite reuses the ids of deleted messages)
+    enqueue('fan_out', msg.id)
+    db.session.commit()
+    current_app.extensions['responses'].invalidate(f"user:{user_id}")
+
+    return msg
+
+
+def delete_message(msg):
+    """Delete `msg` and take it off every timeline.
+
+    Commits, and invalidates the cached pages it showed up on.
+    """
+
+    message_id, user_id = msg.id, msg.user_id
+
+    # Users whose likes_count includes this message. Their likes are deleted
+    # in bulk (as the database would cascade them), so recount afterwards.
+    liker_ids = {
+        liker_id for (liker_id,) in
+        db.session.query(Likes.user_id).filter(Likes.message_id == message_id)
+    }
+
+    TimelineEntry.remove_message(message_id)
+    Likes.query.filter(Likes.message_id == message_id).delete(
+        synchronize_session=False)
+    db.session.delete(msg)
+    db.session.flush()
+    User.refresh_counters(liker_ids)
+    db.session.commit()
+    current_app.extensions['responses'].invalidate(
+        f"message:{message_id}", f"user:{user_id}",
+        *(f"user:{liker_id}" for liker_id in liker_ids))
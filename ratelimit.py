@@ -0,0 +1,243 @@
+"""Token-bucket rate limiting for Warbler's login and signup forms.
+
+Each attempt takes a token from a bucket per client IP and a bucket per
+username. Buckets refill steadily, so a client gets a burst of attempts and
+then a steady trickle, and attempts past that are turned away with a 429
+before the view runs: no user lookup, no bcrypt.
+
+Buckets live in a store. MemoryStore (the default) keeps them in the process,
+so each worker enforces its own limit. SQLiteStore keeps them in a file
+every worker on the host shares; a networked store only needs the same
+`take` and `clear` methods.
+"""
+
+import math
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import request
+
+
+class MemoryStore:
+    """Buckets held in this process, least recently used dropped first.
+
+    A dropped bucket is the same as a full one, so `maxsize` only needs to
+    cover the clients seen within one refill period.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        """Take a token from bucket `key`, which holds up to `capacity`
+        tokens and refills completely in `period` seconds.
+
+        Returns False if the bucket is empty.
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * capacity / period)
+            allowed = tokens >= 1
+
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def clear(self):
+        """Refill every bucket."""
+
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteStore:
+    """Buckets kept in an SQLite file shared by every process on the host.
+
+    Each `take` is one short write transaction, which SQLite serializes
+    across processes.
+    """
+
+    # Delete idle buckets every this many takes
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._takes = 0
+
+    def _connection(self):
+        """This thread's connection to the store."""
+
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                         "key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                         "updated REAL NOT NULL, expires REAL NOT NULL)")
+            self._local.conn = conn
+
+        return conn
+
+    def take(self, key, capacity, period):
+        """Take a token from bucket `key` (see MemoryStore.take)."""
+
+        conn = self._connection()
+        now = time.time()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?",
+                (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens = min(capacity,
+                         tokens + max(now - updated, 0) * capacity / period)
+            allowed = tokens >= 1
+
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit_buckets "
+                "(key, tokens, updated, expires) VALUES (?, ?, ?, ?)",
+                (key, tokens - 1 if allowed else tokens, now, now + period))
+
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                # a bucket left idle for its period is full again
+                conn.execute(
+                    "DELETE FROM rate_limit_buckets WHERE expires < ?", (now,))
+
+            conn.execute("COMMIT")
+
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return allowed
+
+    def clear(self):
+        """Refill every bucket."""
+
+        self._connection().execute("DELETE FROM rate_limit_buckets")
+
+
+def store_from_url(url):
+    """Build the store named by RATE_LIMIT_STORE_URL: empty for in-process,
+    or `sqlite:///<path>` for a file shared by this host's workers."""
+
+    if not url:
+        return MemoryStore()
+
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+
+    raise ValueError(f"Unknown rate limit store: {url}")
+
+
+def normalize_username(username):
+    """`username` as attempts at it are counted: trimmed and lowercased."""
+
+    return username.strip().lower()
+
+
+def rate_limited(view):
+    """Limit POSTs to `view` per client IP and per submitted username.
+
+        @app.route('/login', methods=["GET", "POST"])
+        @rate_limited
+        def login(): ...
+    """
+
+    view.rate_limited = True
+    return view
+
+
+class RateLimiter:
+    """Turns away POSTs to @rate_limited views once a bucket runs dry.
+
+    Settings, from the app config:
+
+    - RATE_LIMIT_STORE_URL: where buckets are kept (see store_from_url)
+    - RATE_LIMIT_PERIOD: seconds for an empty bucket to refill (default 300)
+    - RATE_LIMIT_PER_IP: attempts per period from one IP (default 30;
+      0 disables)
+    - RATE_LIMIT_PER_USERNAME: attempts per period at one username
+      (default 10; 0 disables)
+
+    `rejections` counts the attempts turned away, by endpoint and bucket.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.store = None
+        self.rejections = Counter()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('RATE_LIMIT_STORE_URL', '')
+        app.config.setdefault('RATE_LIMIT_PERIOD', 300)
+        app.config.setdefault('RATE_LIMIT_PER_IP', 30)
+        app.config.setdefault('RATE_LIMIT_PER_USERNAME', 10)
+
+        self.store = store_from_url(app.config['RATE_LIMIT_STORE_URL'])
+        app.before_request(self.check_request)
+
+    def buckets(self):
+        """`(name, key, capacity)` of the buckets this request draws on."""
+
+        config = self.app.config
+        buckets = [('ip', request.remote_addr, config['RATE_LIMIT_PER_IP'])]
+
+        username = normalize_username(request.form.get('username', ''))
+        if username:
+            buckets.append(
+                ('username', username, config['RATE_LIMIT_PER_USERNAME']))
+
+        return buckets
+
+    def check_request(self):
+        """Respond with a 429 if a rate-limited view is out of attempts."""
+
+        if request.method != 'POST':
+            return None
+
+        view = self.app.view_functions.get(request.endpoint)
+        if not getattr(view, 'rate_limited', False):
+            return None
+
+        period = self.app.config['RATE_LIMIT_PERIOD']
+
+        for name, key, capacity in self.buckets():
+            if not capacity:
+                continue
+
+            if not self.store.take(f"{request.endpoint}:{name}:{key}",
+                                   capacity, period):
+                self.rejections[f"{request.endpoint}:{name}"] += 1
+                retry_after = math.ceil(period / capacity)
+
+                return ("Too many attempts. Please try again later.", 429,
+                        {'Retry-After': str(retry_after)})
+
+        return None
+
+    def reset(self):
+        """Refill every bucket and zero the rejection counts."""
+
+        self.store.clear()
+        self.rejections.clear()
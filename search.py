@@ -0,0 +1,255 @@
+"""Full-text search for Warbler.
+
+On Postgres, users and messages are searched through GIN indexes over a
+`tsvector` of their text (username, bio and location for users). On SQLite
+(used for tests and small deployments) the same columns are mirrored into
+FTS5 tables kept in sync by triggers. Both match every search term as a
+prefix and rank the results, so neither has to scan a whole table the way
+`LIKE '%q%'` does.
+
+The indexes are created along with the tables (see the DDL below) and by
+the migrations for existing databases.
+"""
+
+import re
+
+from sqlalchemy import DDL, Float, cast, event, func, literal, literal_column, text, tuple_
+
+from models import db, User, Message
+
+# Postgres document searched for users; the GIN index is built over exactly
+# this expression, so queries must use it verbatim to hit the index.
+USER_SEARCH_DOCUMENT = (
+    "to_tsvector('simple', coalesce(username, '') || ' ' || "
+    "coalesce(bio, '') || ' ' || coalesce(location, ''))")
+
+USER_SEARCH_DDL = {
+    'postgresql': [
+        f"CREATE INDEX ix_users_search ON users USING gin "
+        f"(({USER_SEARCH_DOCUMENT}))",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE users_fts USING fts5("
+        "username, bio, location, content='users', content_rowid='id')",
+        "CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN "
+        "INSERT INTO users_fts(rowid, username, bio, location) "
+        "VALUES (new.id, new.username, new.bio, new.location); END",
+        "CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+        "VALUES ('delete', old.id, old.username, old.bio, old.location); END",
+        "CREATE TRIGGER users_fts_update "
+        "AFTER UPDATE OF username, bio, location ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+        "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+        "INSERT INTO users_fts(rowid, username, bio, location) "
+        "VALUES (new.id, new.username, new.bio, new.location); END",
+    ],
+}
+
+# Postgres document searched for messages (see USER_SEARCH_DOCUMENT)
+MESSAGE_SEARCH_DOCUMENT = "to_tsvector('english', text)"
+
+MESSAGE_SEARCH_DDL = {
+    'postgresql': [
+        f"CREATE INDEX ix_messages_search ON messages USING gin "
+        f"(({MESSAGE_SEARCH_DOCUMENT}))",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE messages_fts USING fts5("
+        "text, content='messages', content_rowid='id', "
+        "tokenize='porter unicode61')",
+        "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+        "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, text) "
+        "VALUES ('delete', old.id, old.text); END",
+        "CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages "
+        "BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, text) "
+        "VALUES ('delete', old.id, old.text); "
+        "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+    ],
+}
+
+# (table, its GIN index on Postgres, its FTS5 table on SQLite, DDL)
+SEARCH_INDEXES = [
+    (User.__table__, 'ix_users_search', 'users_fts', USER_SEARCH_DDL),
+    (Message.__table__, 'ix_messages_search', 'messages_fts',
+     MESSAGE_SEARCH_DDL),
+]
+
+for table, _, fts_table, ddl in SEARCH_INDEXES:
+    for dialect, statements in ddl.items():
+        for statement in statements:
+            event.listen(table, 'after_create',
+                         DDL(statement).execute_if(dialect=dialect))
+
+    event.listen(table, 'before_drop',
+                 DDL(f"DROP TABLE IF EXISTS {fts_table}")
+                 .execute_if(dialect='sqlite'))
+
+
+def drop_search_indexes(connection):
+    """Drop the search indexes (on SQLite, the FTS5 tables and the triggers
+    syncing them), so bulk loads don't update them row by row.
+
+    Put them back with create_search_indexes.
+    """
+
+    dialect = connection.dialect.name
+
+    for _, index, fts_table, _ in SEARCH_INDEXES:
+        if dialect == 'postgresql':
+            connection.execute(f"DROP INDEX IF EXISTS {index}")
+
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                connection.execute(
+                    f"DROP TRIGGER IF EXISTS {fts_table}_{trigger}")
+            connection.execute(f"DROP TABLE IF EXISTS {fts_table}")
+
+
+def create_search_indexes(connection):
+    """Build the search indexes dropped by drop_search_indexes from the
+    current contents of their tables."""
+
+    dialect = connection.dialect.name
+
+    for _, _, fts_table, ddl in SEARCH_INDEXES:
+        for statement in ddl.get(dialect, []):
+            connection.execute(statement)
+
+        if dialect == 'sqlite':
+            connection.execute(
+                f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+
+def search_terms(query_text):
+    """Split a search box entry into lowercase word terms."""
+
+    return re.findall(r'\w+', query_text.lower())
+
+
+def fts_matches(table, terms):
+    """Selectable of `(id, score)` for the rows of FTS5 `table` matching all
+    `terms` as prefixes; higher scores are better matches."""
+
+    return (text(f"SELECT rowid AS id, -bm25({table}) AS score "
+                 f"FROM {table} WHERE {table} MATCH :match")
+            .bindparams(match=' '.join(f'"{term}"*' for term in terms))
+            .columns(id=db.Integer, score=db.Float)
+            .alias(f"{table}_matches"))
+
+
+def search_users(query_text):
+    """Query for users matching every term of `query_text` as a prefix of a
+    word in their username, bio or location, best matches first."""
+
+    terms = search_terms(query_text)
+
+    if not terms:
+        return User.query.filter(db.false())
+
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        document = literal_column(USER_SEARCH_DOCUMENT)
+        tsquery = func.to_tsquery(
+            'simple', ' & '.join(f"{term}:*" for term in terms))
+
+        return (User
+                .query
+                .filter(document.op('@@')(tsquery))
+                .order_by(func.ts_rank(document, tsquery).desc(), User.id))
+
+    if dialect == 'sqlite':
+        matches = fts_matches('users_fts', terms)
+
+        return (User
+                .query
+                .join(matches, matches.c.id == User.id)
+                .order_by(matches.c.score.desc(), User.id))
+
+    # No full-text index: fall back to prefix-matching usernames
+    query = User.query
+    for term in terms:
+        query = query.filter(func.lower(User.username).like(f"{term}%"))
+
+    return query.order_by(User.username)
+
+
+def encode_search_cursor(score, message_id):
+    """Build the `?before=` cursor pointing just past a search result."""
+
+    return f"{score!r}_{message_id}"
+
+
+def decode_search_cursor(cursor):
+    """Split a search cursor into `(score, id)`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    score, _, message_id = cursor.rpartition('_')
+
+    return float(score), int(message_id)
+
+
+def search_messages(query_text, before=None, per_page=20):
+    """One page of messages matching every term of `query_text` as a word
+    prefix, best matches first (newest first among equal matches).
+
+    Pages are keyed on `(score, id)` like the feeds' `(timestamp, id)`
+    cursors (see pagination.py). Returns `(messages, next_cursor)`;
+    `next_cursor` is None on the last page. Raises ValueError if `before`
+    is malformed.
+    """
+
+    terms = search_terms(query_text)
+
+    if not terms:
+        return [], None
+
+    query = Message.with_authors()
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        document = literal_column(MESSAGE_SEARCH_DOCUMENT)
+        tsquery = func.to_tsquery(
+            'english', ' & '.join(f"{term}:*" for term in terms))
+        # ts_rank is a float4; compare it as a float8 so cursor scores
+        # round-trip exactly
+        score = cast(func.ts_rank(document, tsquery), Float(precision=53))
+        query = query.filter(document.op('@@')(tsquery))
+
+    elif dialect == 'sqlite':
+        matches = fts_matches('messages_fts', terms)
+        score = matches.c.score
+        query = query.join(matches, matches.c.id == Message.id)
+
+    else:
+        # No full-text index: match words in order of recency only
+        score = literal(0.0, Float)
+        for term in terms:
+            query = query.filter(func.lower(Message.text).like(f"%{term}%"))
+
+    if before:
+        before_score, before_id = decode_search_cursor(before)
+        query = query.filter(
+            tuple_(score, Message.id) <
+            tuple_(literal(before_score, Float), literal(before_id)))
+
+    # Fetch one extra row to find out whether there's another page
+    rows = (query
+            .add_columns(score)
+            .order_by(score.desc(), Message.id.desc())
+            .limit(per_page + 1)
+            .all())
+
+    next_cursor = None
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_search_cursor(rows[-1][1], rows[-1][0].id)
+
+    return [message for message, _ in rows], next_cursor
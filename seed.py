@@ -1,20 +1,307 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Rows are streamed from the CSVs in batches (COPY on Postgres, executemany
+elsewhere), each committed with a record of how far the load has got, so
+memory use doesn't grow with the files and a failed load can pick up where
+it stopped. Secondary and search indexes are dropped for the load and
+rebuilt once afterwards.
 
+    (venv) $ python seed.py                  # drop everything and reload
+    (venv) $ python seed.py --mode append    # add the CSVs' rows
+    (venv) $ python seed.py --mode resume    # finish an interrupted load
 
-db.drop_all()
-db.create_all()
+The CSVs' user_id and message_id columns refer to users and messages by
+their position in users.csv and messages.csv (the first row is 1). Rows
+are given ids following on from the highest id already in their table,
+and references are shifted to match, so appended rows point at the rows
+appended with them. A file's references to a table whose CSV isn't being
+loaded are taken as ids as they are.
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+import csv
+import io
+import os
+import time
+from contextlib import contextmanager
+from itertools import islice
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from flask_migrate import stamp
+from sqlalchemy import Column, Integer, MetaData, String, Table, func, select
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from app import app, db
+from models import User, Message, Follows, Likes, TimelineEntry
+from search import drop_search_indexes, create_search_indexes
 
-db.session.commit()
+# CSV files loaded, in order, and the tables they load into. Missing files
+# are skipped.
+CSV_TABLES = [
+    ('users.csv', User.__table__),
+    ('messages.csv', Message.__table__),
+    ('follows.csv', Follows.__table__),
+    ('likes.csv', Likes.__table__),
+]
+
+# How many rows of each file have been committed. Kept out of the models'
+# metadata: it's the loader's bookkeeping, not part of the app's schema.
+progress_metadata = MetaData()
+
+seed_progress = Table(
+    'seed_progress', progress_metadata,
+    Column('filename', String, primary_key=True),
+    Column('rows_loaded', Integer, nullable=False, default=0),
+    # id given to the file's first row, for tables with an id column
+    Column('first_id', Integer),
+)
+
+# DBAPI placeholder for each paramstyle
+PLACEHOLDERS = {
+    'qmark': '?',
+    'format': '%s',
+    'pyformat': '%s',
+}
+
+
+def batches(rows, size):
+    """Split the iterator `rows` into lists of at most `size` rows."""
+
+    while True:
+        batch = list(islice(rows, size))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def copy_rows(cursor, table, columns, batch):
+    """Load `batch` into `table` with Postgres's COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(batch)
+    buffer.seek(0)
+
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+def insert_rows(cursor, table, columns, batch, paramstyle):
+    """Load `batch` into `table` with a single executemany."""
+
+    placeholders = ', '.join([PLACEHOLDERS[paramstyle]] * len(columns))
+
+    # empty CSV fields are NULLs, as they are to COPY
+    cursor.executemany(
+        f"INSERT INTO {table.name} ({', '.join(columns)}) "
+        f"VALUES ({placeholders})",
+        ([value or None for value in row] for row in batch))
+
+
+def next_id(conn, table):
+    """The id after the highest in `table`, or None if it has no id."""
+
+    if 'id' not in table.c:
+        return None
+
+    return conn.execute(
+        select([func.coalesce(func.max(table.c.id), 0) + 1])).scalar()
+
+
+def referenced_table(table, column):
+    """Name of the table `column` of `table` is a foreign key to, if any."""
+
+    for foreign_key in table.c[column].foreign_keys:
+        return foreign_key.column.table.name
+
+    return None
+
+
+def shift_ids(row, shifts):
+    """`row` with each reference moved by its column's shift."""
+
+    return [str(int(value) + shift) if shift and value else value
+            for value, shift in zip(row, shifts)]
+
+
+def load_csv(path, table, batch_size, id_offsets):
+    """Stream the rows of the CSV at `path` into `table`, skipping the rows
+    an earlier load already committed.
+
+    `id_offsets` maps the names of the tables loaded so far to how far
+    their ids are from their CSV positions; references to them are shifted
+    by that much, and this table's offset is added.
+
+    Returns the number of rows loaded.
+    """
+
+    filename = os.path.basename(path)
+    loaded = 0
+
+    with db.engine.connect() as conn:
+        already = conn.execute(
+            seed_progress.select()
+            .where(seed_progress.c.filename == filename)).first()
+
+        if already is None:
+            first_id = next_id(conn, table)
+            conn.execute(seed_progress.insert(), filename=filename,
+                         rows_loaded=0, first_id=first_id)
+            skip = 0
+        else:
+            skip, first_id = already.rows_loaded, already.first_id
+
+        cursor = conn.connection.cursor()
+
+        with open(path, newline='') as f:
+            rows = csv.reader(f)
+            columns = next(rows)
+            shifts = [id_offsets.get(referenced_table(table, column), 0)
+                      for column in columns]
+
+            if first_id is not None:
+                id_offsets[table.name] = first_id - 1
+                columns = ['id'] + columns
+
+            for batch in batches(islice(rows, skip, None), batch_size):
+                batch = [shift_ids(row, shifts) for row in batch]
+
+                if first_id is not None:
+                    start = first_id + skip + loaded
+                    batch = [[start + n] + row for n, row in enumerate(batch)]
+
+                with conn.begin():
+                    if conn.dialect.name == 'postgresql':
+                        copy_rows(cursor, table, columns, batch)
+                    else:
+                        insert_rows(cursor, table, columns, batch,
+                                    conn.dialect.paramstyle)
+
+                    loaded += len(batch)
+                    conn.execute(
+                        seed_progress.update()
+                        .where(seed_progress.c.filename == filename)
+                        .values(rows_loaded=skip + loaded))
+
+        if first_id is not None and conn.dialect.name == 'postgresql':
+            # the ids were given explicitly, so move the sequence past them
+            conn.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"(SELECT max(id) FROM {table.name}))")
+
+    return loaded
+
+
+@contextmanager
+def deferred_indexes(tables, search=False):
+    """Drop the secondary indexes of `tables` (and the search indexes, if
+    `search`) for the duration of the block, then build them again.
+
+    Unique constraints are left alone, since the load relies on them.
+    """
+
+    indexes = [index for table in tables for index in table.indexes]
+
+    with db.engine.begin() as conn:
+        for index in indexes:
+            conn.execute(f"DROP INDEX IF EXISTS {index.name}")
+
+        if search:
+            drop_search_indexes(conn)
+
+    try:
+        yield
+
+    finally:
+        with timed("Rebuilt indexes"), db.engine.begin() as conn:
+            for index in indexes:
+                index.create(bind=conn)
+
+            if search:
+                create_search_indexes(conn)
+
+
+@contextmanager
+def timed(done):
+    """Print `done` and how long the block took."""
+
+    start = time.perf_counter()
+    yield
+    print(f"{done} in {time.perf_counter() - start:.1f}s")
+
+
+def seed(data_dir='generator', mode='replace', batch_size=10000):
+    """Load the CSVs in `data_dir` into the database.
+
+    `mode` is one of:
+
+    - replace: drop all tables and load from scratch (marking the
+      database as up to date with the migrations)
+    - append: load every row of the CSVs into the existing tables, after
+      the rows already there
+    - resume: load only the rows an earlier load didn't get to
+    """
+
+    if mode == 'replace':
+        db.drop_all()
+
+    if mode != 'resume':
+        # dropped rather than emptied, in case it's from before a column
+        # was added
+        progress_metadata.drop_all(bind=db.engine)
+
+    # only creates what's missing when appending/resuming
+    db.create_all()
+    progress_metadata.create_all(bind=db.engine)
+
+    if mode == 'replace':
+        # the tables were just created from the models, so they're at the
+        # latest migration; record that, or `flask db upgrade` would try to
+        # create them again
+        with app.app_context():
+            stamp()
+
+    files = [(os.path.join(data_dir, filename), table)
+             for filename, table in CSV_TABLES
+             if os.path.exists(os.path.join(data_dir, filename))]
+
+    id_offsets = {}
+
+    with deferred_indexes([table for _, table in files], search=True):
+        for path, table in files:
+            start = time.perf_counter()
+            rows = load_csv(path, table, batch_size, id_offsets)
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            print(f"Loaded {rows:,} rows from {path} in {elapsed:.1f}s "
+                  f"({rows / elapsed:,.0f} rows/s)")
+
+    # Bulk loads skip the fan-out and counters maintained when posting,
+    # so build them here
+    with deferred_indexes([TimelineEntry.__table__]):
+        with timed("Rebuilt timelines"):
+            TimelineEntry.rebuild()
+            db.session.commit()
+
+    with timed("Recounted users' counters"):
+        User.refresh_counters()
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory holding the CSVs (default: generator)")
+    parser.add_argument('--mode', choices=['replace', 'append', 'resume'],
+                        default='replace',
+                        help="replace: drop all tables first (default); "
+                             "append: keep existing rows; "
+                             "resume: finish an interrupted load")
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help="rows per batch/transaction (default: 10000)")
+    args = parser.parse_args()
+
+    seed(args.data_dir, args.mode, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Slow query log for Warbler.
+
+Statements that take longer than SLOW_QUERY_THRESHOLD_MS are written to
+the SLOW_QUERY_LOG file, one JSON object per line:
+
+    {"time": "2020-05-01T12:00:00.000000", "duration_ms": 312.5,
+     "endpoint": "homepage", "statement": "SELECT ... WHERE likes.message_id
+     IN (...)", "parameters": ["int", "int*20"], "plan": ["..."]}
+
+Statements are normalized (whitespace collapsed, `IN` lists of any length
+written `IN (...)`) and only the types of their parameters are kept, so
+the lines for one query look alike and no user data ends up in the log.
+The plan is EXPLAINed right after the statement runs, on the same
+connection, for SELECTs on Postgres and SQLite.
+"""
+
+import json
+import logging
+import random
+import re
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+# A bind parameter in any of the DBAPI paramstyles
+PARAMETER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+
+# `IN (...)` holding only bind parameters
+IN_LIST = re.compile(rf'\bIN \(\s*{PARAMETER}(?:\s*,\s*{PARAMETER})*\s*\)',
+                     re.IGNORECASE)
+
+# Statements we ask for a plan of
+EXPLAINABLE = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+
+
+def normalize_sql(statement):
+    """`statement` on one line, with lists of bind parameters collapsed."""
+
+    return IN_LIST.sub('IN (...)', ' '.join(statement.split()))
+
+
+def parameter_shape(parameters):
+    """The types of `parameters` (a sequence or a dict), without values.
+
+    Runs of one type in a sequence are written `type*count`.
+    """
+
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__
+                for name, value in parameters.items()}
+
+    shape = []
+    for value in parameters or ():
+        name = type(value).__name__
+        if shape and shape[-1][0] == name:
+            shape[-1][1] += 1
+        else:
+            shape.append([name, 1])
+
+    return [name if count == 1 else f"{name}*{count}"
+            for name, count in shape]
+
+
+class SlowQueryLog:
+    """Logs the statements an engine runs slowly.
+
+    Settings, from the app config:
+
+    - SLOW_QUERY_LOG: path of the log file (default: empty, which turns the
+      log off). Rotated at SLOW_QUERY_LOG_MAX_BYTES (default 10MB), keeping
+      SLOW_QUERY_LOG_BACKUPS old files (default 5).
+    - SLOW_QUERY_THRESHOLD_MS: statements taking at least this long are
+      slow (default 200)
+    - SLOW_QUERY_SAMPLE_RATE: fraction of slow statements logged (default
+      1, all of them)
+    - SLOW_QUERY_EXPLAIN: whether to add the statement's plan (default on)
+
+    Without an `engine`, logs the app's Flask-SQLAlchemy engine, fetched
+    only once a log file is set.
+    """
+
+    def __init__(self, app=None, engine=None):
+        self.app = None
+        self.logger = None
+
+        if app is not None:
+            self.init_app(app, engine)
+
+    def init_app(self, app, engine=None):
+        self.app = app
+        app.config.setdefault('SLOW_QUERY_LOG', '')
+        app.config.setdefault('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', 5)
+        app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', 200)
+        app.config.setdefault('SLOW_QUERY_SAMPLE_RATE', 1.0)
+        app.config.setdefault('SLOW_QUERY_EXPLAIN', True)
+
+        path = app.config['SLOW_QUERY_LOG']
+        if not path:
+            return
+
+        handler = RotatingFileHandler(
+            path,
+            maxBytes=app.config['SLOW_QUERY_LOG_MAX_BYTES'],
+            backupCount=app.config['SLOW_QUERY_LOG_BACKUPS'])
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+        # not from getLogger, so each log keeps to its own file
+        self.logger = logging.Logger('warbler.slow_queries', logging.INFO)
+        self.logger.addHandler(handler)
+
+        if engine is None:
+            engine = app.extensions['sqlalchemy'].db.get_engine(app)
+
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        """Note when a statement starts."""
+
+        conn.info['slow_query_start'] = time.perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        """Log the statement if it was slow (and sampled)."""
+
+        start = conn.info.pop('slow_query_start', None)
+
+        if start is None:
+            return
+
+        seconds = time.perf_counter() - start
+        config = self.app.config
+
+        if (seconds * 1000 < config['SLOW_QUERY_THRESHOLD_MS'] or
+                random.random() >= config['SLOW_QUERY_SAMPLE_RATE']):
+            return
+
+        entry = {
+            'time': datetime.utcnow().isoformat(),
+            'duration_ms': round(seconds * 1000, 3),
+            'endpoint': request.endpoint if has_request_context() else None,
+            'statement': normalize_sql(statement),
+            'parameters': parameter_shape(
+                parameters[0] if executemany and parameters else parameters),
+        }
+
+        if executemany:
+            entry['rows'] = len(parameters)
+
+        elif config['SLOW_QUERY_EXPLAIN'] and EXPLAINABLE.match(statement):
+            entry['plan'] = self.explain(conn, statement, parameters)
+
+        self.logger.info(json.dumps(entry))
+
+    def explain(self, conn, statement, parameters):
+        """Plan of `statement`, or the error explaining it raised."""
+
+        from explain import explain_sql  # explain imports models
+
+        cursor = conn.connection.cursor()
+
+        try:
+            return explain_sql(cursor, conn.dialect.name, statement,
+                               parameters)
+        except Exception as error:
+            return [f"EXPLAIN failed: {error}"]
+        finally:
+            cursor.close()
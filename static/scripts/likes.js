@@ -0,0 +1,23 @@
+// Like/unlike messages in place instead of reloading the page.
+// Falls back to a normal form submit if the request fails.
+
+$(document).on('submit', 'form.messages-like', function (evt) {
+  evt.preventDefault();
+
+  const $form = $(this);
+  const $button = $form.find('button');
+
+  $.ajax({
+    url: $form.attr('action'),
+    method: 'POST',
+    headers: { Accept: 'application/json' },
+  })
+    .done(function (resp) {
+      $button
+        .toggleClass('btn-primary', resp.liked)
+        .toggleClass('btn-secondary', !resp.liked);
+    })
+    .fail(function () {
+      $form[0].submit();
+    });
+});
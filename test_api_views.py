@@ -0,0 +1,226 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api_views.py
+
+
+from app import app, CURR_USER_KEY, session_users, responses, fragments
+import gzip
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Run background jobs (see jobs.py) in the request, instead of queueing them
+app.config['JOBS_SYNC'] = True
+
+
+class ApiViewTestCase(TestCase):
+    """Test views of the JSON API."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+        session_users.clear()
+        responses.clear()
+        fragments.clear()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.testuser.id = 9999
+        self.u1 = User.signup("abc", "test1@test.com", "password", None)
+        self.u1.id = 1111
+        self.u2 = User.signup("efg", "test2@test.com", "password", None)
+        self.u2.id = 2222
+        db.session.commit()
+
+        self.testuser_id = self.testuser.id
+
+    def tearDown(self):
+        resp = super().tearDown()
+        db.session.rollback()
+        return resp
+
+    def login(self, c, user_id=9999):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_timeline_pagination(self):
+        """Does the timeline page through followed users' messages?"""
+
+        db.session.add(Follows(user_being_followed_id=1111,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 1111)
+            for i in range(5):
+                c.post("/api/v1/messages", json={"text": f"warble {i}"})
+
+            self.login(c)
+            resp = c.get("/api/v1/timeline?limit=3")
+            self.assertEqual(resp.status_code, 200)
+            page = resp.get_json()
+
+            self.assertEqual([m['text'] for m in page['messages']],
+                             ["warble 4", "warble 3", "warble 2"])
+            self.assertEqual(page['messages'][0]['user']['username'], "abc")
+
+            resp = c.get(f"/api/v1/timeline?limit=3&before={page['next']}")
+            page = resp.get_json()
+            self.assertEqual([m['text'] for m in page['messages']],
+                             ["warble 1", "warble 0"])
+            self.assertIsNone(page['next'])
+
+    def test_timeline_unauthorized(self):
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.get_json())
+
+    def test_profile(self):
+        db.session.add(Follows(user_being_followed_id=1111,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            profile = c.get("/api/v1/users/1111").get_json()
+
+        self.assertEqual(profile['username'], "abc")
+        self.assertEqual(profile['followers_count'], 1)
+        self.assertTrue(profile['followed'])
+        self.assertNotIn('password', profile)
+        self.assertNotIn('email', profile)
+
+        self.assertEqual(self.client.get("/api/v1/users/1").status_code, 404)
+
+    def test_followers_pagination(self):
+        db.session.add_all([
+            Follows(user_being_followed_id=self.testuser_id,
+                    user_following_id=1111),
+            Follows(user_being_followed_id=self.testuser_id,
+                    user_following_id=2222),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            page = c.get("/api/v1/users/9999/followers?limit=1").get_json()
+            self.assertEqual([u['username'] for u in page['users']], ["abc"])
+
+            page = c.get(
+                f"/api/v1/users/9999/followers?limit=1&after={page['next']}"
+            ).get_json()
+            self.assertEqual([u['username'] for u in page['users']], ["efg"])
+            self.assertIsNone(page['next'])
+
+            page = c.get("/api/v1/users/1111/following").get_json()
+            self.assertEqual([u['id'] for u in page['users']], [9999])
+
+    def test_likes(self):
+        old = Message(text="old warble", user_id=1111,
+                      timestamp=datetime(2020, 1, 1))
+        new = Message(text="liked warble", user_id=1111)
+        db.session.add_all([old, new])
+        db.session.commit()
+        # newest like first: the old message, liked last
+        db.session.add(Likes(user_id=self.testuser_id, message_id=new.id))
+        db.session.commit()
+        db.session.add(Likes(user_id=self.testuser_id, message_id=old.id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            page = c.get("/api/v1/users/9999/likes?limit=1").get_json()
+            self.assertEqual([m['text'] for m in page['messages']],
+                             ["old warble"])
+
+            page = c.get("/api/v1/users/9999/likes?limit=1"
+                         f"&before={page['next']}").get_json()
+            self.assertEqual([m['text'] for m in page['messages']],
+                             ["liked warble"])
+            self.assertIsNone(page['next'])
+
+            resp = c.get("/api/v1/users/9999/likes?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_create_and_delete_message(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.post("/api/v1/messages", data="text=not json")
+            self.assertEqual(resp.status_code, 415)
+
+            resp = c.post("/api/v1/messages", json={"text": ""})
+            self.assertEqual(resp.status_code, 400)
+
+            for body in (["hi"], "hi", 1):
+                resp = c.post("/api/v1/messages", json=body)
+                self.assertEqual(resp.status_code, 400)
+
+            resp = c.post("/api/v1/messages", json={"text": "hello api"})
+            self.assertEqual(resp.status_code, 201)
+            message_id = resp.get_json()['id']
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=message_id).count(),
+                1)
+
+            resp = c.delete(f"/api/v1/messages/{message_id}")
+            self.assertEqual(resp.status_code, 204)
+            self.assertIsNone(Message.query.get(message_id))
+
+    def test_delete_others_message(self):
+        msg = Message(text="not yours", user_id=1111)
+        db.session.add(msg)
+        db.session.commit()
+        message_id = msg.id
+
+        with self.client as c:
+            self.login(c)
+            resp = c.delete(f"/api/v1/messages/{message_id}")
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertIsNotNone(Message.query.get(message_id))
+
+    def test_gzip(self):
+        """Are big responses gzipped for clients accepting it?"""
+
+        for i in range(20):
+            db.session.add(Message(text=f"warble number {i}", user_id=1111))
+        db.session.commit()
+
+        resp = self.client.get("/api/v1/users/1111/messages",
+                               headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        page = json.loads(gzip.decompress(resp.data))
+        self.assertEqual(len(page['messages']), 20)
+
+        resp = self.client.get("/api/v1/users/1111/messages")
+        self.assertNotIn('Content-Encoding', resp.headers)
@@ -0,0 +1,202 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_jobs.py
+
+
+from app import app, CURR_USER_KEY, session_users, responses, fragments
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import jobs
+from models import db, User, Message, Follows, Job, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JobsTestCase(TestCase):
+    """Test queueing and running background jobs."""
+
+    def setUp(self):
+        """Queue jobs instead of running them; add a user and a follower."""
+
+        db.drop_all()
+        db.create_all()
+        session_users.clear()
+        responses.clear()
+        fragments.clear()
+        app.config['JOBS_SYNC'] = False
+
+        # jobs reads its settings from current_app
+        self.context = app.app_context()
+        self.context.push()
+
+        self.client = app.test_client()
+
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="password", image_url=None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=follower.id))
+        db.session.commit()
+
+        self.author_id = author.id
+        self.follower_id = follower.id
+
+    def tearDown(self):
+        db.session.rollback()
+        jobs.registry.pop('flaky', None)
+        app.config['JOBS_SYNC'] = True
+        self.context.pop()
+
+    def timeline(self, user_id):
+        return [entry.message_id for entry in
+                TimelineEntry.query.filter_by(user_id=user_id)]
+
+    def log_in(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_post_queues_fan_out(self):
+        """Posting should queue the fan-out, which a worker then runs"""
+
+        with self.client as c:
+            self.log_in(c, self.author_id)
+            resp = c.post("/messages/new", data={"text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.one()
+        # the author sees it at once; followers once the job has run
+        self.assertEqual(self.timeline(self.author_id), [msg.id])
+        self.assertEqual(self.timeline(self.follower_id), [])
+
+        job = Job.query.one()
+        self.assertEqual((job.name, job.args, job.key, job.status),
+                         ('fan_out', [msg.id], None, 'queued'))
+
+        self.assertEqual(jobs.work(once=True), 1)
+
+        self.assertEqual(self.timeline(self.follower_id), [msg.id])
+        self.assertEqual(Job.query.one().status, 'done')
+
+        # running it again changes nothing
+        jobs.fan_out(msg.id)
+        self.assertEqual(self.timeline(self.follower_id), [msg.id])
+
+    def test_fan_out_reused_id(self):
+        """A message reusing a deleted message's id should be fanned out"""
+
+        with self.client as c:
+            self.log_in(c, self.author_id)
+            c.post("/messages/new", data={"text": "First"})
+            jobs.work(once=True)
+
+            first_id = Message.query.one().id
+            c.post(f"/messages/{first_id}/delete")
+            c.post("/messages/new", data={"text": "Second"})
+
+        msg = Message.query.one()
+        self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual(self.timeline(self.follower_id), [msg.id])
+
+    def test_enqueue_idempotent(self):
+        """A job shouldn't be queued twice with the same key"""
+
+        jobs.enqueue('fan_out', 1, key="fan_out:1")
+        jobs.enqueue('fan_out', 1, key="fan_out:1")
+        jobs.enqueue('fan_out', 1)
+        db.session.commit()
+
+        self.assertEqual(Job.query.filter_by(key="fan_out:1").count(), 1)
+        self.assertEqual(Job.query.count(), 2)
+
+    def test_retries_then_fails(self):
+        """A failing job should be retried later, up to its attempts"""
+
+        @jobs.job
+        def flaky():
+            raise ValueError("Not today")
+
+        app.config.update(JOBS_MAX_ATTEMPTS=2, JOBS_RETRY_DELAY=10)
+        try:
+            jobs.enqueue('flaky')
+            db.session.commit()
+
+            self.assertEqual(jobs.work(once=True), 1)
+        finally:
+            app.config.update(JOBS_MAX_ATTEMPTS=5)
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn("ValueError: Not today", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow() + timedelta(seconds=5))
+
+        # not due yet
+        self.assertIsNone(jobs.claim())
+
+        job = jobs.claim(datetime.utcnow() + timedelta(seconds=20))
+        self.assertEqual(job.attempts, 2)
+        self.assertFalse(jobs.run(job))
+
+        self.assertEqual(Job.query.one().status, 'failed')
+        self.assertIsNone(jobs.claim(datetime.utcnow() + timedelta(days=1)))
+
+    def test_expired_lease(self):
+        """A job whose worker died should be run again once its lease ends"""
+
+        jobs.enqueue('fan_out', 1)
+        db.session.commit()
+
+        job = jobs.claim()
+        self.assertEqual((job.status, job.attempts), ('running', 1))
+        self.assertIsNone(jobs.claim())
+
+        later = datetime.utcnow() + timedelta(seconds=app.config['JOBS_LEASE'] + 1)
+        job = jobs.claim(later)
+        self.assertEqual((job.status, job.attempts), ('running', 2))
+
+    def test_follow_then_unfollow(self):
+        """Timeline jobs should leave the timeline matching the follows,
+        whichever order they run in"""
+
+        other = User.signup(username="other", email="other@test.com",
+                            password="password", image_url=None)
+        db.session.flush()
+        db.session.add(Message(text="From other", user_id=other.id))
+        db.session.commit()
+        other_id = other.id
+
+        with self.client as c:
+            self.log_in(c, self.follower_id)
+            c.post(f"/users/follow/{other_id}")
+            c.post(f"/users/stop-following/{other_id}")
+
+        backfill, prune = Job.query.order_by(Job.id).all()
+        self.assertEqual(backfill.name, 'backfill_timeline')
+        self.assertEqual(prune.name, 'prune_timeline')
+
+        jobs.run(jobs.claim())
+        jobs.run(jobs.claim())
+        self.assertEqual(self.timeline(self.follower_id), [])
+
+    def test_work_command(self):
+        """`flask jobs work --once` should run the due jobs"""
+
+        jobs.enqueue('fan_out', 1)
+        jobs.enqueue('fan_out', 2)
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['jobs', 'work', '--once'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Ran 2 jobs", result.output)
+        self.assertEqual(jobs.status_counts(), {'done': 2})
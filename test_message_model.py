@@ -9,7 +9,8 @@ from app import app
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Likes
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from explain import hot_queries, explain_query
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -106,3 +107,51 @@ class MessageModelTestCase(TestCase):
 
         self.assertEqual(len(likes), 1)
         self.assertEqual(likes[0].message_id, m1.id)
+
+        # other users can like the same message
+        self.u.likes.append(m1)
+        db.session.commit()
+
+        self.assertEqual(Likes.query.filter_by(message_id=m1.id).count(), 2)
+
+    def test_liked_among(self):
+        """Only the viewer's likes among the given messages are returned"""
+
+        m1 = Message(id=1, text="Test 1", user_id=self.uid)
+        m2 = Message(id=2, text="Test 2", user_id=self.uid)
+        m3 = Message(id=3, text="Test 3", user_id=self.uid)
+        db.session.add_all([m1, m2, m3])
+        db.session.commit()
+
+        db.session.add_all([
+            Likes(user_id=self.uid, message_id=1),
+            Likes(user_id=self.uid, message_id=3),
+        ])
+        db.session.commit()
+
+        self.assertEqual(Likes.liked_among(self.uid, [1, 2]), {1})
+        self.assertEqual(Likes.liked_among(self.uid, [1, 2, 3]), {1, 3})
+        self.assertEqual(Likes.liked_among(67890, [1, 2, 3]), set())
+        self.assertEqual(Likes.liked_among(self.uid, []), set())
+
+    def test_rebuild_timelines_self_follow(self):
+        """Rebuilding timelines should cope with users following themselves"""
+
+        db.session.add(Follows(user_being_followed_id=self.uid,
+                               user_following_id=self.uid))
+        db.session.add(Message(id=1, text="Test 1", user_id=self.uid))
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.assertEqual(
+            [(entry.user_id, entry.message_id)
+             for entry in TimelineEntry.query],
+            [(self.uid, 1)])
+
+    def test_explain_hot_queries(self):
+        """Every hot query should produce a query plan"""
+
+        for description, query in hot_queries(self.uid).items():
+            self.assertTrue(explain_query(query), description)
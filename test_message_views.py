@@ -5,11 +5,15 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, session_users, responses, fragments
 import os
+from contextlib import contextmanager
 from unittest import TestCase
+from sqlalchemy import event
+from bs4 import BeautifulSoup
 
-from models import db, connect_db, Message, User
+from models import (db, connect_db, Message, User, Follows, Likes,
+                    TimelineEntry)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -31,6 +35,29 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs (see jobs.py) in the request, instead of queueing them
+app.config['JOBS_SYNC'] = True
+
+# Most SQL statements a rendered feed page may issue, however many messages
+# (and authors) it shows
+MAX_FEED_QUERIES = 4
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -40,6 +67,9 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        session_users.clear()
+        fragments.clear()
+        responses.clear()
 
         self.client = app.test_client()
 
@@ -74,6 +104,158 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_fans_out(self):
+        """New messages should land in the author's and followers' timelines"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="password",
+                               image_url=None)
+        follower.id = 2222
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=2222))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Hello followers"})
+
+        msg = Message.query.one()
+        entries = TimelineEntry.query.filter_by(message_id=msg.id).all()
+        self.assertEqual(sorted(e.user_id for e in entries),
+                         [2222, self.testuser_id])
+        self.assertEqual(TimelineEntry.messages_for(2222).all(), [msg])
+
+    def test_feed_query_count(self):
+        """Rendering a feed shouldn't issue a query per message author"""
+
+        for n in range(1, 6):
+            author = User.signup(username=f"author{n}",
+                                 email=f"author{n}@test.com",
+                                 password="password",
+                                 image_url=None)
+            author.id = n
+            db.session.add_all([
+                Follows(user_being_followed_id=n,
+                        user_following_id=self.testuser_id),
+                Message(text=f"first from author{n}", user_id=n),
+                Message(text=f"second from author{n}", user_id=n),
+            ])
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            for url in ["/", f"/users/{self.testuser_id}/likes"]:
+                with count_queries() as statements:
+                    resp = c.get(url)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertLessEqual(len(statements), MAX_FEED_QUERIES)
+
+            self.assertEqual(str(resp.data).count("@author"), 0)
+            resp = c.get("/")
+            self.assertEqual(str(resp.data).count("@author"), 10)
+
+    def test_feed_parallel_fetch(self):
+        """Fetching the feed's queries at once should render the same page"""
+
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        db.session.add(author)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=self.testuser_id))
+        messages = [Message(text=f"message {n}", user_id=author.id)
+                    for n in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add(Likes(user_id=self.testuser_id,
+                             message_id=messages[1].id))
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            pages = []
+            for parallel in (False, True):
+                app.config['FEED_PARALLEL_FETCH'] = parallel
+                try:
+                    resp = c.get("/?before=nonsense")
+                    self.assertEqual(resp.status_code, 400)
+
+                    resp = c.get("/")
+                finally:
+                    app.config['FEED_PARALLEL_FETCH'] = False
+
+                self.assertEqual(resp.status_code, 200)
+                pages.append(resp.get_data(as_text=True))
+
+        self.assertEqual(pages[0], pages[1])
+        self.assertIn("message 2", pages[1])
+        self.assertEqual(pages[1].count("btn-primary"), 1)
+
+    def test_message_search(self):
+        """Search should find messages by word prefix, a page at a time"""
+
+        db.session.add_all([
+            Message(id=1, text="Birds are singing", user_id=self.testuser_id),
+            Message(id=2, text="Nothing to see here", user_id=self.testuser_id),
+            Message(id=3, text="A bird in the hand", user_id=self.testuser_id),
+            Message(id=4, text="Birdwatching today", user_id=self.testuser_id),
+        ])
+        db.session.commit()
+
+        app.config['FEED_PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                resp = c.get("/messages/search?q=bird")
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn("Nothing to see here", str(resp.data))
+                self.assertIn("load-more", str(resp.data))
+
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                found = {p.text for p in soup.select("#messages p")}
+                load_more = soup.find("a", {"class": "load-more"})
+
+                resp = c.get(f"/messages/search{load_more['href']}")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                found |= {p.text for p in soup.select("#messages p")}
+                self.assertNotIn("load-more", str(resp.data))
+
+                self.assertEqual(found, {"Birds are singing",
+                                         "A bird in the hand",
+                                         "Birdwatching today"})
+
+                resp = c.get("/messages/search?q=bird&before=nonsense")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['FEED_PAGE_SIZE'] = 20
+
+    def test_message_search_after_delete(self):
+        """Deleted messages shouldn't be found"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "ephemeral warble"})
+            resp = c.get("/messages/search?q=ephemeral")
+            self.assertIn("ephemeral warble", str(resp.data))
+
+            msg = Message.query.one()
+            c.post(f"/messages/{msg.id}/delete")
+            resp = c.get("/messages/search?q=ephemeral")
+            self.assertNotIn("ephemeral warble", str(resp.data))
+
     def test_add_no_session(self):
         """Access should be denied if user is not logged into session"""
 
@@ -115,6 +297,44 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(m.text, str(resp.data))
 
+    def test_message_show_cached(self):
+        """Are anonymous views of a message cached until it's deleted?"""
+
+        db.session.add(Message(id=9999, text="This is a test message",
+                               user_id=self.testuser_id))
+        db.session.commit()
+
+        anon = app.test_client()
+        resp = anon.get("/messages/9999")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("public", resp.headers['Cache-Control'])
+        self.assertIn("max-age=60", resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+
+        with count_queries() as statements:
+            resp = anon.get("/messages/9999")
+
+        self.assertEqual(statements, [])
+        self.assertIn("This is a test message", str(resp.data))
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = anon.get("/messages/9999", headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # logged-in users get a private copy
+            resp = c.get("/messages/9999")
+            self.assertIn("private", resp.headers['Cache-Control'])
+
+            c.post("/messages/9999/delete")
+
+        resp = anon.get("/messages/9999")
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn("no-store", resp.headers['Cache-Control'])
+
     def test_invalid_message_show(self):
         """Test view of message that doesn't exist"""
         with self.client as c:
@@ -147,6 +367,58 @@ class MessageViewTestCase(TestCase):
             m = Message.query.get(1234)
             self.assertIsNone(m)
 
+    def test_message_delete_prunes_timeline(self):
+        """Deleted messages should be removed from timelines"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "short-lived"})
+            msg = Message.query.one()
+            c.post(f"/messages/{msg.id}/delete")
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_message_delete_recounts_likes(self):
+        """Deleting a message should take it off its likers' like counts"""
+
+        liker = User.signup(username="liker", email="liker@test.com",
+                            password="password", image_url=None)
+        msg = Message(text="liked", user_id=self.testuser_id)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add(Likes(user_id=liker.id, message_id=msg.id))
+        db.session.commit()
+        liker_id, message_id = liker.id, msg.id
+        self.assertEqual(User.query.get(liker_id).likes_count, 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/messages/{message_id}/delete")
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(liker_id).likes_count, 0)
+
+    def test_message_card_reused_id(self):
+        """A message reusing a deleted message's id shouldn't be shown
+        with the deleted message's cached card"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "OLD SECRET"})
+            c.get("/")
+            c.post(f"/messages/{Message.query.one().id}/delete")
+            c.post("/messages/new", data={"text": "new text"})
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("new text", html)
+        self.assertNotIn("OLD SECRET", html)
+
     def test_unauthorized_message_delete(self):
         """Users should not have access to delete other users messages"""
 
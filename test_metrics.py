@@ -0,0 +1,207 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_metrics.py
+
+
+from app import app, limiter, request_metrics, CURR_USER_KEY, session_users
+import os
+from unittest import TestCase, mock
+
+from flask import Flask
+from sqlalchemy import create_engine, exc
+
+import metrics
+from metrics import InstrumentedQueuePool, pool_stats
+from models import db, pool_options, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['METRICS_TOKEN'] = "test-token"
+
+# Run background jobs (see jobs.py) in the request, instead of queueing them
+app.config['JOBS_SYNC'] = True
+
+
+class MetricsTestCase(TestCase):
+    """Test the pool and request instrumentation, and metrics endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        session_users.clear()
+
+        pool_stats.clear()
+        request_metrics.clear()
+        limiter.reset()
+        self.client = app.test_client()
+        self.auth = {'Authorization': "Bearer test-token"}
+
+    def tearDown(self):
+        db.session.rollback()
+        pool_stats.clear()
+        request_metrics.clear()
+        limiter.reset()
+
+    def test_pool_counts_checkouts(self):
+        """Checkouts should be counted, and ones that time out too"""
+
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.1)
+
+        conn = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        conn.close()
+
+        engine.connect().close()
+
+        stats = pool_stats.as_dict()
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_checkout_ms'], 100)
+
+        pool = metrics.pool_metrics(engine.pool)
+        self.assertEqual(pool['size'], 1)
+        self.assertEqual(pool['checked_out'], 0)
+        self.assertEqual(pool['checked_in'], 1)
+
+    def test_pool_options(self):
+        """Pool settings should apply to Postgres but not SQLite"""
+
+        other = Flask(__name__)
+        other.config.update(
+            SQLALCHEMY_DATABASE_URI='postgresql:///warbler',
+            DB_POOL_SIZE=20,
+            DB_MAX_OVERFLOW=0,
+            DB_POOL_PRE_PING=True,
+            DB_STATEMENT_TIMEOUT=5000)
+
+        options = pool_options(other)
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': "-c statement_timeout=5000"})
+
+        # the app's default URL names the backend 'postgres'
+        other.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///warbler'
+        self.assertEqual(pool_options(other)['connect_args'],
+                         {'options': "-c statement_timeout=5000"})
+
+        other.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/other.db'
+        self.assertEqual(pool_options(other), {})
+
+    def test_metrics_endpoint(self):
+        """Metrics should include the pool and rate limit rejections"""
+
+        limiter.rejections['login:ip'] += 2
+
+        resp = self.client.get("/internal/metrics", headers=self.auth)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['pid'], os.getpid())
+        self.assertIn('checkouts', resp.json['pool'])
+        self.assertEqual(resp.json['rate_limit_rejections'], {'login:ip': 2})
+
+    def test_metrics_endpoint_token(self):
+        """Metrics should only be shown with the token, and not at all
+        without one set"""
+
+        resp = self.client.get("/internal/metrics")
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get("/internal/metrics",
+                               headers={'Authorization': "Bearer wrong"})
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get("/internal/metrics",
+                               headers={'Authorization': "Bearer wröng"})
+        self.assertEqual(resp.status_code, 404)
+
+        with mock.patch.dict(app.config, {'METRICS_TOKEN': ''}):
+            resp = self.client.get("/internal/metrics",
+                                   headers={'Authorization': "Bearer "})
+            self.assertEqual(resp.status_code, 404)
+
+    def make_feed(self):
+        """Add a user following an author of 3 messages; returns their id."""
+
+        user = User.signup(username="testuser", email="test@test.com",
+                           password="testuser", image_url=None)
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=user.id))
+        db.session.add_all([Message(text=f"message {n}", user_id=author.id)
+                            for n in range(3)])
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        return user.id
+
+    def test_request_metrics(self):
+        """Requests should be timed, with their SQL counted, per endpoint"""
+
+        user_id = self.make_feed()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get("/")
+            c.get("/")
+            resp = c.get("/internal/metrics", headers=self.auth)
+
+        home = resp.json['requests']['homepage']
+        self.assertEqual(home['requests'], 2)
+        self.assertEqual(sum(count for _, count in home['histogram_ms']), 2)
+        self.assertGreaterEqual(home['avg_queries'], 3)
+        # the 3 messages and their author
+        self.assertGreaterEqual(home['avg_rows'], 4)
+        self.assertNotIn('internal.show_metrics', resp.json['requests'])
+
+    def test_request_metrics_parallel_fetch(self):
+        """Queries run by the feed's fetch threads should count too"""
+
+        user_id = self.make_feed()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get("/")
+            app.config['FEED_PARALLEL_FETCH'] = True
+            try:
+                c.get("/")
+            finally:
+                app.config['FEED_PARALLEL_FETCH'] = False
+
+        home = request_metrics.endpoints['homepage']
+        self.assertEqual(home.requests, 2)
+        # the second request ran at least as many queries as the first
+        self.assertGreaterEqual(home.queries, 6)
+
+    def test_server_timing(self):
+        """Requests should report their timing only when configured to"""
+
+        resp = self.client.get("/")
+        self.assertNotIn('Server-Timing', resp.headers)
+
+        app.config['SERVER_TIMING'] = True
+        try:
+            resp = self.client.get("/signup")
+        finally:
+            app.config['SERVER_TIMING'] = False
+
+        self.assertRegex(
+            resp.headers['Server-Timing'],
+            r'^app;dur=[\d.]+, sql;dur=[\d.]+;desc="0 queries, 0 rows"$')
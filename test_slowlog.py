@@ -0,0 +1,108 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import (Column, Integer, MetaData, String, Table,
+                        create_engine, select)
+
+from slowlog import SlowQueryLog, normalize_sql, parameter_shape
+
+metadata = MetaData()
+
+notes = Table('notes', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('text', String))
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test logging slow statements."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'slow.jsonl')
+
+        self.app = Flask(__name__)
+        self.app.add_url_rule('/feed', 'feed', lambda: '')
+        self.app.config.update(SLOW_QUERY_LOG=self.path,
+                               SLOW_QUERY_THRESHOLD_MS=0)
+
+        self.engine = create_engine('sqlite://')
+        metadata.create_all(self.engine)
+        self.log = SlowQueryLog(self.app, self.engine)
+
+    def tearDown(self):
+        for handler in self.log.logger.handlers:
+            handler.close()
+        self.dir.cleanup()
+
+    def entries(self):
+        with open(self.path) as log:
+            return [json.loads(line) for line in log]
+
+    def test_normalize_sql(self):
+        """Statements should be on one line with IN lists collapsed"""
+
+        self.assertEqual(
+            normalize_sql("SELECT id\n  FROM likes\n WHERE user_id = ? "
+                          "AND message_id IN (?, ?, ?)"),
+            "SELECT id FROM likes WHERE user_id = ? AND message_id IN (...)")
+        self.assertEqual(
+            normalize_sql("SELECT 1 WHERE x IN (%(x_1)s, %(x_2)s)"),
+            "SELECT 1 WHERE x IN (...)")
+        self.assertEqual(
+            normalize_sql("SELECT 1 WHERE x IN (SELECT y FROM z)"),
+            "SELECT 1 WHERE x IN (SELECT y FROM z)")
+
+    def test_parameter_shape(self):
+        """Parameters should be described by type, without values"""
+
+        self.assertEqual(parameter_shape((5, 1, 2, 3, '%q%')),
+                         ['int*4', 'str'])
+        self.assertEqual(parameter_shape({'text': 'hi', 'id': None}),
+                         {'text': 'str', 'id': 'NoneType'})
+        self.assertEqual(parameter_shape(()), [])
+
+    def test_slow_select_logged(self):
+        """Slow SELECTs should be logged with their endpoint and plan"""
+
+        with self.app.test_request_context('/feed'):
+            self.engine.execute(
+                select([notes.c.text]).where(notes.c.id.in_([1, 2, 3])))
+
+        [entry] = self.entries()
+        self.assertEqual(entry['endpoint'], 'feed')
+        self.assertIn("WHERE notes.id IN (...)", entry['statement'])
+        self.assertEqual(entry['parameters'], ['int*3'])
+        self.assertTrue(entry['plan'])
+        self.assertNotIn("EXPLAIN failed", entry['plan'][0])
+
+    def test_executemany_logged(self):
+        """Bulk inserts should be logged with their row count, unexplained"""
+
+        self.engine.execute(notes.insert(), [{'text': 'a'}, {'text': 'b'}])
+
+        [entry] = self.entries()
+        self.assertIsNone(entry['endpoint'])
+        self.assertEqual(entry['rows'], 2)
+        self.assertNotIn('plan', entry)
+
+    def test_fast_or_unsampled_not_logged(self):
+        """Statements under the threshold, or not sampled, should be skipped"""
+
+        self.app.config['SLOW_QUERY_THRESHOLD_MS'] = 60000
+        self.engine.execute(select([notes.c.text]))
+
+        self.app.config.update(SLOW_QUERY_THRESHOLD_MS=0,
+                               SLOW_QUERY_SAMPLE_RATE=0)
+        self.engine.execute(select([notes.c.text]))
+
+        self.assertEqual(self.entries(), [])
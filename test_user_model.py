@@ -96,6 +96,68 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.u2.is_followed_by(self.u1))
         self.assertFalse(self.u1.is_followed_by(self.u2))
 
+    def test_following_ids_among(self):
+        u3 = User.signup("test3", "test3@test.com", "password", None)
+        u3.id = 3333
+        db.session.add(u3)
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        self.assertEqual(
+            self.u1.following_ids_among([self.u2.id, u3.id, 4444]),
+            {self.u2.id})
+        self.assertEqual(self.u2.following_ids_among([self.u1.id]), set())
+        self.assertEqual(self.u1.following_ids_among([]), set())
+
+    ####
+    #
+    # Counter tests
+    #
+    ####
+    def test_counters(self):
+        """Counter columns should follow inserts and deletes"""
+        follow = Follows(user_being_followed_id=self.u2.id,
+                         user_following_id=self.u1.id)
+        msg = Message(text="counted", user_id=self.u2.id)
+        db.session.add_all([follow, msg])
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.followers_count, 0)
+        self.assertEqual(self.u2.followers_count, 1)
+        self.assertEqual(self.u2.messages_count, 1)
+
+        db.session.delete(follow)
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 0)
+        self.assertEqual(self.u2.followers_count, 0)
+
+    def test_refresh_counters(self):
+        """refresh_counters should recount rows written outside the ORM"""
+        self.u1.following.append(self.u2)
+        db.session.commit()
+        self.assertEqual(self.u2.followers_count, 0)
+
+        User.refresh_counters([self.u1.id, self.u2.id])
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.followers_count, 1)
+
+    def test_updated_at(self):
+        """updated_at should change with card columns, not counters"""
+        version = self.u1.updated_at
+
+        User.adjust_counters(self.u1.id, likes_count=1)
+        self.u1.location = "Nowhere"
+        db.session.commit()
+        self.assertEqual(self.u1.updated_at, version)
+
+        self.u1.username = "renamed"
+        db.session.commit()
+        self.assertGreater(self.u1.updated_at, version)
+
     ####
     #
     # Signup tests
@@ -161,6 +223,20 @@ class UserModelTestCase(TestCase):
         self.assertIsNotNone(user)
         self.assertEqual(user.id, self.u1.id)
 
+    def test_rehash_on_authentication(self):
+        """Passwords hashed at an old cost should be rehashed on login"""
+        self.assertTrue(self.u1.password.startswith("$2b$12$"))
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            user = User.authenticate(self.u1.username, "password")
+            db.session.commit()
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+        self.assertTrue(user.password.startswith("$2b$04$"))
+        self.assertEqual(User.authenticate(self.u1.username, "password"), user)
+
     def test_invalid_username(self):
         """Should return False if incorrect username"""
         self.assertFalse(User.authenticate("wrong_username", "password"))
@@ -5,11 +5,15 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-from app import app, CURR_USER_KEY
+from app import (app, CURR_USER_KEY, session_users, limiter, failed_logins,
+                 responses, fragments)
 import os
-from unittest import TestCase
+import tempfile
+from datetime import datetime
+from unittest import TestCase, mock
 
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, Message, User, Likes, Follows, TimelineEntry
+from ratelimit import SQLiteStore
 from bs4 import BeautifulSoup
 
 # BEFORE we import our app, let's set an environmental variable
@@ -33,6 +37,9 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs (see jobs.py) in the request, instead of queueing them
+app.config['JOBS_SYNC'] = True
+
 
 class UserViewTestCase(TestCase):
     """Test views for messages."""
@@ -42,6 +49,11 @@ class UserViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        session_users.clear()
+        responses.clear()
+        fragments.clear()
+        failed_logins.clear()
+        limiter.reset()
 
         self.client = app.test_client()
 
@@ -97,6 +109,37 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("@efg", str(resp.data))
             self.assertNotIn("@hij", str(resp.data))
 
+    def test_users_search_bio_and_location(self):
+        self.u1.bio = "Birdwatcher and amateur ornithologist"
+        self.u2.location = "San Francisco"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=ornith")
+            self.assertIn("@abc", str(resp.data))
+            self.assertNotIn("@efg", str(resp.data))
+
+            resp = c.get("/users?q=san+fran")
+            self.assertIn("@efg", str(resp.data))
+            self.assertNotIn("@abc", str(resp.data))
+
+            resp = c.get("/users?q=nobody")
+            self.assertIn("no users found", str(resp.data))
+
+    def test_user_index_pagination(self):
+        app.config['USERS_PAGE_SIZE'] = 3
+        try:
+            with self.client as c:
+                resp = c.get("/users")
+                self.assertEqual(str(resp.data).count("card-link"), 3)
+                self.assertIn("next-page", str(resp.data))
+
+                resp = c.get("/users?page=2")
+                self.assertEqual(str(resp.data).count("card-link"), 2)
+                self.assertNotIn("next-page", str(resp.data))
+        finally:
+            app.config['USERS_PAGE_SIZE'] = 24
+
     def test_user_show(self):
         with self.client as c:
             resp = c.get(f"users/{self.testuser.id}")
@@ -104,6 +147,155 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser", str(resp.data))
 
+    def test_user_show_pagination(self):
+        """Profile messages should page with a `before` cursor"""
+
+        db.session.add_all([
+            Message(id=n, text=f"warble number {n}", user_id=self.testuser_id,
+                    timestamp=datetime(2020, 1, n))
+            for n in range(1, 4)
+        ])
+        db.session.commit()
+
+        app.config['FEED_PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.get(f"/users/{self.testuser_id}")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+
+                self.assertIn("warble number 3", str(resp.data))
+                self.assertIn("warble number 2", str(resp.data))
+                self.assertNotIn("warble number 1", str(resp.data))
+
+                load_more = soup.find("a", {"class": "load-more"})
+                resp = c.get(f"/users/{self.testuser_id}{load_more['href']}")
+
+                self.assertIn("warble number 1", str(resp.data))
+                self.assertNotIn("warble number 2", str(resp.data))
+                self.assertNotIn("load-more", str(resp.data))
+
+                resp = c.get(f"/users/{self.testuser_id}?before=nonsense")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['FEED_PAGE_SIZE'] = 20
+
+    def test_user_likes_pagination(self):
+        """Likes should page newest like first, whatever the messages' ages"""
+
+        db.session.add_all([
+            Message(id=n, text=f"warble number {n}", user_id=self.u1_id,
+                    timestamp=datetime(2020, 1, n))
+            for n in range(1, 4)
+        ])
+        db.session.commit()
+        # liked oldest message last
+        db.session.add_all([Likes(user_id=self.testuser_id, message_id=n)
+                            for n in (2, 3, 1)])
+        db.session.commit()
+
+        app.config['FEED_PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.get(f"/users/{self.testuser_id}/likes")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+
+                self.assertIn("warble number 1", str(resp.data))
+                self.assertIn("warble number 3", str(resp.data))
+                self.assertNotIn("warble number 2", str(resp.data))
+
+                load_more = soup.find("a", {"class": "load-more"})
+                resp = c.get(f"/users/{self.testuser_id}/likes"
+                             f"{load_more['href']}")
+
+                self.assertIn("warble number 2", str(resp.data))
+                self.assertNotIn("warble number 3", str(resp.data))
+                self.assertNotIn("load-more", str(resp.data))
+
+                resp = c.get(f"/users/{self.testuser_id}/likes?before=nonsense")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['FEED_PAGE_SIZE'] = 20
+
+    def test_user_show_cache_invalidation(self):
+        """Do writes invalidate the cached anonymous profile page?"""
+
+        anon = app.test_client()
+        resp = anon.get(f"/users/{self.testuser_id}")
+        self.assertNotIn("a brand new warble", str(resp.data))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "a brand new warble"})
+
+        resp = anon.get(f"/users/{self.testuser_id}")
+        self.assertIn("a brand new warble", str(resp.data))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.testuser_id}")
+
+        # the follower count changed
+        soup = BeautifulSoup(anon.get(f"/users/{self.testuser_id}").data,
+                             'html.parser')
+        self.assertIn("1", soup.find_all("li", {"class": "stat"})[2].text)
+
+    def test_message_card_cache(self):
+        """Are message cards reused, and re-rendered after a profile edit?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "first warble"})
+            c.post("/messages/new", data={"text": "second warble"})
+
+            c.get("/")
+            self.assertEqual(len(fragments), 2)
+
+            resp = c.get("/")
+            self.assertEqual(len(fragments), 2)
+            self.assertEqual(str(resp.data).count(">@testuser</a>"), 2)
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "image_url": "",
+                                           "header_image_url": "",
+                                           "bio": "",
+                                           "password": "testuser"})
+
+            resp = c.get("/")
+            self.assertEqual(str(resp.data).count(">@renamed</a>"), 2)
+            self.assertNotIn("@testuser<", str(resp.data))
+
+    def test_session_user_cache(self):
+        """g.user should be cached between requests until the profile changes"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/users")
+            self.assertEqual(session_users.get(self.testuser_id)['username'],
+                             "testuser")
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+            self.assertIsNone(session_users.get(self.testuser_id))
+
+            resp = c.get("/users")
+            self.assertIn('alt="renamed"', str(resp.data))
+
     ####
     #
     # Users likes tests
@@ -196,6 +388,26 @@ class UserViewTestCase(TestCase):
             # like has been deleted
             self.assertEqual(len(likes), 0)
 
+    def test_toggle_like_json(self):
+        """Like toggles should answer with JSON when asked to"""
+
+        m = Message(id=7777, text="Testing json like", user_id=self.u1.id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            headers = {"Accept": "application/json"}
+            resp = c.post("/messages/7777/like", headers=headers)
+            self.assertEqual(resp.json, {"message_id": 7777, "liked": True})
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
+
+            resp = c.post("/messages/7777/like", headers=headers)
+            self.assertEqual(resp.json, {"message_id": 7777, "liked": False})
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+
     def test_unauthorized_like(self):
         """Test if user tries to like message while not logged in"""
 
@@ -290,6 +502,29 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("@hij", str(resp.data))
             self.assertNotIn("@testing", str(resp.data))
 
+    def test_follow_backfills_timeline(self):
+        """Following a user should add their messages to the home page"""
+
+        m = Message(id=5555, text="welcome to my timeline",
+                    user_id=self.u1_id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+            resp = c.get("/")
+            self.assertIn("welcome to my timeline", str(resp.data))
+
+            c.post(f"/users/stop-following/{self.u1_id}")
+            resp = c.get("/")
+            self.assertNotIn("welcome to my timeline", str(resp.data))
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.testuser_id).count(), 0)
+
     def test_unauthorized_following_page_access(self):
         """Test if user tries to view following while not logged in"""
 
@@ -313,3 +548,112 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn("@abc", str(resp.data))
             self.assertIn("Access unauthorized", str(resp.data))
+
+    ####
+    #
+    # Login rate limiting tests
+    #
+    ####
+    def test_login_rate_limit(self):
+        """Are attempts at a username turned away once they run out?"""
+
+        with mock.patch.dict(app.config, {'RATE_LIMIT_PER_USERNAME': 3}):
+            with self.client as c:
+                for attempt in range(3):
+                    resp = c.post("/login", data={"username": "testuser",
+                                                  "password": f"wrong{attempt}"})
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn("Invalid credentials", str(resp.data))
+
+                # even the right password is turned away now
+                resp = c.post("/login", data={"username": "testuser",
+                                              "password": "testuser"})
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn('Retry-After', resp.headers)
+
+                # other usernames still get their attempts
+                resp = c.post("/login", data={"username": "abc",
+                                              "password": "password"})
+                self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(limiter.rejections['login:username'], 1)
+
+    def test_failed_login_cache(self):
+        """Is a repeated wrong password turned away without rechecking it?"""
+
+        with mock.patch.object(User, 'authenticate',
+                               wraps=User.authenticate) as authenticate:
+            with self.client as c:
+                for _ in range(2):
+                    resp = c.post("/login", data={"username": "testuser",
+                                                  "password": "wrong-password"})
+                    self.assertIn("Invalid credentials", str(resp.data))
+
+                self.assertEqual(authenticate.call_count, 1)
+
+                resp = c.post("/login", data={"username": "testuser",
+                                              "password": "testuser"})
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(authenticate.call_count, 2)
+
+    def test_failed_login_cache_username_case(self):
+        """Failures are kept under the username as the rate limiter counts it,
+        but only repeats of the exact attempt are turned away"""
+
+        with self.client as c:
+            resp = c.post("/login", data={"username": "TestUser",
+                                          "password": "testuser"})
+            self.assertIn("Invalid credentials", str(resp.data))
+            self.assertIsNotNone(failed_logins.get("testuser"))
+
+            resp = c.post("/login", data={"username": "testuser",
+                                          "password": "testuser"})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_failed_login_cache_rename(self):
+        """Failures at a name should be forgotten when a user takes it"""
+
+        with self.client as c:
+            resp = c.post("/login", data={"username": "Renamed",
+                                          "password": "testuser"})
+            self.assertIn("Invalid credentials", str(resp.data))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/users/profile", data={"username": "Renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+            c.get("/logout")
+
+            resp = c.post("/login", data={"username": "Renamed",
+                                          "password": "testuser"})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_rate_limit_ignores_forwarded_for(self):
+        """Without trusted proxies, X-Forwarded-For can't pick the IP bucket"""
+
+        with mock.patch.dict(app.config, {'RATE_LIMIT_PER_IP': 2}):
+            with self.client as c:
+                for n in range(3):
+                    resp = c.post("/login", data={"username": f"nobody{n}",
+                                                  "password": "password"},
+                                  headers={'X-Forwarded-For': f"10.0.0.{n}"})
+
+                self.assertEqual(resp.status_code, 429)
+
+    def test_sqlite_rate_limit_store(self):
+        """Do workers sharing an SQLite store share its buckets?"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'buckets.db')
+            worker1 = SQLiteStore(path)
+            worker2 = SQLiteStore(path)
+
+            self.assertTrue(worker1.take('login:ip:1.2.3.4', 2, 60))
+            self.assertTrue(worker2.take('login:ip:1.2.3.4', 2, 60))
+            self.assertFalse(worker1.take('login:ip:1.2.3.4', 2, 60))
+            self.assertTrue(worker2.take('login:ip:5.6.7.8', 2, 60))
+
+            worker2.clear()
+            self.assertTrue(worker1.take('login:ip:1.2.3.4', 2, 60))